@@ -0,0 +1,326 @@
+#! /usr/bin/env python
+
+# Benchmark of toolchainbot itself. Synthetic binutils/gcc/glibc/linux
+# tarballs, whose configure scripts and Makefiles burn CPU, write files and
+# allocate memory like a scaled down real build, are built by the bot with
+# several job counts and cache states. The time of the whole run and of every
+# stage comes from the bot's --report.
+
+import os
+import shutil
+import sys
+import getopt
+import json
+import subprocess
+import tarfile
+import time
+import StringIO
+
+# Default versions of the aarch64 builtin target.
+benchVersions = {
+    'binutils' : '2.23.2',
+    'gcc'      : '4.8.1',
+    'glibc'    : '2.17',
+    'linux'    : '3.9.4',
+}
+
+# Work of every source package: number of objects, CPU seconds, megabytes
+# written and megabytes allocated per object, and the size of the tarball in
+# megabytes. gcc has the most and the biggest objects, glibc writes the most.
+benchProfile = {
+    'binutils' : {'objects': 40,  'cpu': 0.02, 'write': 0.5, 'memory': 20,  'size': 4},
+    'gcc'      : {'objects': 120, 'cpu': 0.04, 'write': 0.5, 'memory': 60,  'size': 12},
+    'glibc'    : {'objects': 80,  'cpu': 0.02, 'write': 1.0, 'memory': 30,  'size': 8},
+    'linux'    : {'objects': 30,  'cpu': 0.01, 'write': 0.2, 'memory': 10,  'size': 16},
+}
+
+# Compile one object: busy loop, allocation and write of the object file.
+workload = ("import sys, time\n"
+            "cpu, write, memory, name = float(sys.argv[1]), float(sys.argv[2]), "
+            "int(sys.argv[3]), sys.argv[4]\n"
+            "block = bytearray(memory << 20)\n"
+            "for i in range(0, len(block), 4096): block[i] = 1\n"
+            "end = time.time() + cpu\n"
+            "while time.time() < end: pass\n"
+            "f = open(name, 'wb')\n"
+            "f.write(b'\\0' * int(write * 1048576))\n"
+            "f.close()\n")
+
+configureScript = """#!/bin/sh
+prefix=/usr/local
+target=none
+for arg in "$@"; do
+    case "$arg" in
+    --prefix=*) prefix="${arg#--prefix=}";;
+    --target=*) target="${arg#--target=}";;
+    esac
+done
+src=$(cd "$(dirname "$0")" && pwd)
+echo "configure $@"
+sed -e "s|@PREFIX@|$prefix|g" -e "s|@TARGET@|$target|g" -e "s|@SRC@|$src|g" \
+    "$src/Makefile.in" > Makefile
+"""
+
+# The targets the bot makes and installs for every package.
+makeTargets = {
+    'binutils' : ('all', 'install'),
+    'gcc'      : ('all all-gcc all-target-libgcc',
+                  'install install-gcc install-target-libgcc'),
+    'glibc'    : ('all', 'install'),
+}
+
+installCommands = {
+    'binutils' : ['mkdir -p $(DESTDIR)@PREFIX@/bin $(DESTDIR)@PREFIX@/@TARGET@/bin',
+                  'cp obj-0.o $(DESTDIR)@PREFIX@/bin/@TARGET@-as',
+                  'cp obj-0.o $(DESTDIR)@PREFIX@/@TARGET@/bin/as'],
+    'gcc'      : ['mkdir -p $(DESTDIR)@PREFIX@/bin $(DESTDIR)@PREFIX@/lib/gcc',
+                  'cp obj-0.o $(DESTDIR)@PREFIX@/bin/@TARGET@-gcc',
+                  'cp obj-1.o $(DESTDIR)@PREFIX@/lib/gcc/$@.o'],
+    'glibc'    : ['mkdir -p $(install_root)@PREFIX@/lib $(install_root)@PREFIX@/include',
+                  'cp obj-*.o $(install_root)@PREFIX@/lib/',
+                  'echo "/* stdio */" > $(install_root)@PREFIX@/include/stdio.h'],
+}
+
+def objectRules(profile, python, scale):
+    objects = ' '.join(['obj-%d.o' % i for i in range(profile['objects'])])
+    return ('OBJECTS = ' + objects + '\n\n' +
+            'obj-%.o:\n' +
+            '\t@' + python + ' @SRC@/workload.py %g %g %d $@\n\n' %
+            (profile['cpu'] * scale, profile['write'] * scale,
+             int(profile['memory'] * scale)))
+
+def packageMakefile(name, python, scale):
+    profile = benchProfile[name]
+    build, install = makeTargets[name]
+    lines = [objectRules(profile, python, scale),
+             build + ': $(OBJECTS)\n\t@echo built ' + name + '\n\n',
+             install + ': $(OBJECTS)\n']
+    for command in installCommands[name]:
+        lines.append('\t' + command + '\n')
+    return ''.join(lines)
+
+def linuxMakefile(python, scale):
+    profile = benchProfile['linux']
+    # make runs in the source tree, the objects go to the build tree.
+    rules = objectRules(profile, python, scale).replace('obj-', '$(O)/obj-')
+    return ('O ?= .\n' + rules.replace('@SRC@', '$(CURDIR)') +
+            'mrproper:\n\t@echo mrproper\n\n' +
+            'headers_check: $(OBJECTS)\n\t@echo headers_check $(ARCH)\n\n' +
+            'headers_install: $(OBJECTS)\n' +
+            '\tmkdir -p $(INSTALL_HDR_PATH)/include/linux $(INSTALL_HDR_PATH)/include/asm\n' +
+            '\techo $(ARCH) > $(INSTALL_HDR_PATH)/include/asm/arch.h\n' +
+            '\techo v > $(INSTALL_HDR_PATH)/include/linux/version.h\n')
+
+# Add a file to a tarball. The data of the tarballs is random, so that their
+# decompression costs about what it costs for real sources.
+def addFile(tar, name, data, mode=0644):
+    info = tarfile.TarInfo(name)
+    info.size  = len(data)
+    info.mode  = mode
+    info.mtime = 1000000000
+    tar.addfile(info, StringIO.StringIO(data))
+
+# Write the synthetic tarballs into 'downloads'.
+def makeSources(downloads, python, scale):
+    if not os.path.exists(downloads):
+        os.makedirs(downloads)
+    for name in sorted(benchVersions.keys()):
+        fullName = name + '-' + benchVersions[name]
+        tarball = downloads + '/' + fullName + '.tar.bz2'
+        tar = tarfile.open(tarball, 'w:bz2')
+        try:
+            if name == 'linux':
+                addFile(tar, fullName + '/Makefile', linuxMakefile(python, scale))
+            else:
+                addFile(tar, fullName + '/configure', configureScript, 0755)
+                addFile(tar, fullName + '/Makefile.in', packageMakefile(name, python, scale))
+            addFile(tar, fullName + '/workload.py', workload)
+            size = int(benchProfile[name]['size'] * scale * 1048576)
+            addFile(tar, fullName + '/data.bin', os.urandom(size))
+        finally:
+            tar.close()
+
+# Sum the wall time of the steps of every stage of a report. The tarballs of
+# the 'source' stage are extracted concurrently, so its sum is more than the
+# time it takes.
+def stageTimes(report):
+    times = {}
+    for record in report:
+        times[record['stage']] = times.get(record['stage'], 0.0) + record['wall']
+    return times
+
+# Run the bot on a fresh copy of the sources, return the wall time of the
+# run and of every stage. 'cache' is the stage cache directory, '' for none.
+# The synthetic toolchain can't build the test programs, the verify stage is
+# skipped.
+def runBot(bot, python, root, sources, jobs, cache):
+    workdir = root + '/work'
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir + '/build')
+    shutil.copytree(sources, workdir + '/downloads')
+    args = [python, bot, '--builtin=aarch64', '--prefix=' + workdir + '/install',
+            '--jobs=' + str(jobs), '--report=' + workdir + '/report.json', '--skip=verify']
+    if cache != '':
+        args.append('--cache-dir=' + cache)
+    log = open(root + '/bot.log', 'a')
+    try:
+        start = time.time()
+        ret = subprocess.call(args, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        wall = time.time() - start
+    finally:
+        log.close()
+    if ret != 0:
+        print('Error! The bot failed, see ' + root + '/bot.log')
+        sys.exit(1)
+    f = open(workdir + '/report.json')
+    try:
+        report = json.load(f)
+    finally:
+        f.close()
+    # The scenario is wrong if the bot ran more jobs than it was asked to.
+    granted = max([0] + [record.get('jobs', 0) for record in report])
+    if granted > jobs:
+        print('Error! The bot ran stages with ' + str(granted) + ' jobs instead of ' +
+              str(jobs) + ', see ' + workdir + '/report.json')
+        sys.exit(1)
+    return wall, stageTimes(report)
+
+# Run every scenario: each job count without stage cache, with an empty
+# cache (cold) and with the cache filled by the cold run (warm).
+def runBench(bot, python, root, jobsList, repeat, scale):
+    sources = root + '/sources'
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    makeSources(sources, python, scale)
+    results = []
+    for jobs in jobsList:
+        cache = root + '/cache-' + str(jobs)
+        for state, cacheDir in [('nocache', ''), ('cold', cache), ('warm', cache)]:
+            walls = []
+            stages = {}
+            for i in range(repeat):
+                if state == 'cold' and os.path.exists(cache):
+                    shutil.rmtree(cache)
+                wall, times = runBot(bot, python, root, sources, jobs, cacheDir)
+                walls.append(wall)
+                for stage, t in times.items():
+                    stages.setdefault(stage, []).append(t)
+            # The median hides the odd slow run.
+            result = {'jobs': jobs, 'cache': state, 'wall': median(walls),
+                      'stages': dict([(s, median(t)) for s, t in stages.items()])}
+            printResult(result)
+            results.append(result)
+    return results
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+stageOrder = ['source', 'header-arm64-3.9.4', 'header', 'binutils', 'gcc1', 'glibc',
+              'libpath', 'gcc2']
+
+def printResult(result):
+    stages = ' '.join(['%s=%.2f' % (s, result['stages'][s])
+                       for s in stageOrder if s in result['stages']])
+    print('jobs=%-3d %-8s wall=%7.2fs  %s' % (result['jobs'], result['cache'],
+                                             result['wall'], stages))
+    sys.stdout.flush()
+
+# Compare the results with a baseline, return the scenarios slower than the
+# baseline by more than 'threshold' (a fraction).
+def compareResults(results, baseline, threshold):
+    regressions = []
+    old = dict([((r['jobs'], r['cache']), r) for r in baseline])
+    for result in results:
+        key = (result['jobs'], result['cache'])
+        if key not in old:
+            continue
+        if result['wall'] > old[key]['wall'] * (1 + threshold):
+            regressions.append('jobs=%d %s : %.2fs, was %.2fs' %
+                               (key[0], key[1], result['wall'], old[key]['wall']))
+    return regressions
+
+def printHelpMessage():
+    helpMsg = """Usage: toolchainbench [OPTIONS] ...
+benchmark toolchainbot with synthetic sources.
+
+    -h, --help              Print this help message
+        --dir=path          Working directory, removed first (default
+                            ./bench)
+        --jobs=list         Comma separated job counts (default 1,4)
+        --repeat=number     Runs of every scenario, the median is kept
+                            (default 1)
+        --scale=factor      Multiply the work of the synthetic packages
+                            (default 1.0)
+        --python=program    Python interpreter running the bot (default the
+                            one running the benchmark)
+        --output=filename   Write the results as JSON
+        --compare=filename  Compare with the results of a previous --output,
+                            exit with an error if a scenario got slower
+        --threshold=percent Slowdown allowed by --compare (default 10)
+"""
+    print(helpMsg)
+    sys.exit(0)
+
+def main():
+    root      = 'bench'
+    jobsList  = [1, 4]
+    repeat    = 1
+    scale     = 1.0
+    python    = sys.executable
+    output    = ''
+    compare   = ''
+    threshold = 10.0
+    try:
+        optionsList, others = getopt.getopt(sys.argv[1:], 'h',
+                                            ['help', 'dir=', 'jobs=', 'repeat=',
+                                             'scale=', 'python=', 'output=',
+                                             'compare=', 'threshold='])
+        for item in optionsList:
+            if item[0] in ['-h', '--help']:
+                printHelpMessage()
+            elif item[0] == '--dir':
+                root = item[1]
+            elif item[0] == '--jobs':
+                jobsList = [int(jobs) for jobs in item[1].split(',')]
+            elif item[0] == '--repeat':
+                repeat = max(1, int(item[1]))
+            elif item[0] == '--scale':
+                scale = float(item[1])
+            elif item[0] == '--python':
+                python = item[1]
+            elif item[0] == '--output':
+                output = item[1]
+            elif item[0] == '--compare':
+                compare = item[1]
+            elif item[0] == '--threshold':
+                threshold = float(item[1])
+    except getopt.GetoptError, exc:
+        print(exc.msg)
+        sys.exit(1)
+    except ValueError:
+        print('Error ! Wrong number in options.')
+        sys.exit(1)
+    bot = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'toolchainbot.py')
+    results = runBench(bot, python, os.path.abspath(root), jobsList, repeat, scale)
+    if output != '':
+        f = open(output, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if compare != '':
+        f = open(compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        regressions = compareResults(results, baseline, threshold / 100.0)
+        for line in regressions:
+            print('Regression : ' + line)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
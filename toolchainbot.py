@@ -4,10 +4,49 @@ import os
 import shutil
 import sys
 import getopt
+import gzip
+import collections
+import bisect
+import multiprocessing
+import re
+import fcntl
+import httplib
+import socket
+import urllib
+import urlparse
+import csv
+import errno
+import hashlib
+import hmac
+import json
 import subprocess
+import threading
+import time
+import traceback
+import Queue
 import ConfigParser
+import pipes
+import struct
+import select
+import signal
+import tempfile
+import BaseHTTPServer
+import SocketServer
 
-class BuildOptions:
+# A configuration which can't change once frozen, the stages of every build
+# read it from their own threads without locking.
+class FrozenConfig:
+    frozen = False
+
+    def __setattr__(self, name, value):
+        if self.frozen:
+            raise AttributeError('Configuration is frozen, can\'t set ' + name)
+        self.__dict__[name] = value
+
+    def freeze(self):
+        self.__dict__['frozen'] = True
+
+class BuildOptions(FrozenConfig):
     target = ''
     prefix = ''
     sysroot = ''
@@ -15,8 +54,17 @@ class BuildOptions:
     libhost = ''
     libprefix = ''
     jobs   = ''
+    # Reuse configured build directories.
+    incremental = False
+    # Compiler launcher and its cache directory.
+    launcher    = ''
+    launcherDir = ''
+    # ScratchSpace holding the object trees, shared by all toolchains.
+    scratch     = None
+    # MakeJobserver shared by all toolchains.
+    jobserver   = None
 
-class BuildConfig:
+class BuildConfig(FrozenConfig):
     # Target directory.
     workdir  = ''
     prefix   = ''
@@ -31,6 +79,8 @@ class BuildConfig:
     src_gcc      = ''
     src_glibc    = ''
     src_linux    = ''
+    # Directory of tarballs and source trees shared between workdirs.
+    sharedCache  = ''
 
     # Built-in configuration
     target       = ''
@@ -46,45 +96,34 @@ class BuildConfig:
     endian       = ''
     kernel_header = ''
 
-    options = BuildOptions()
-
     def __init__(self):
-        pass
-
-class SourceVersion:
-    major = 0
-    minor = 0
-    extra = 0
+        # Every configuration has its own options, several toolchains may be
+        # built at the same time.
+        self.options = BuildOptions()
 
-    def __init__(self, stringVersion):
-        verList = stringVersion.split('.')
-        if len(verList) < 2:
-            raise
-        self.major = int(verList[0])
-        self.minor = int(verList[1])
-        if len(verList) == 2:
-            self.extra = 0
-        else:
-            self.extra = int(verList[2])
+    # Freeze the configuration and its options once the build is set up.
+    def freeze(self):
+        self.options.freeze()
+        FrozenConfig.freeze(self)
 
-    def __lt__(self, other):
-        if self.major < other.major:
-            return True
-        elif self.major > other.major:
-            return False
-        if self.minor < other.minor:
-            return True
-        elif self.minor > other.minor:
-            return False
-        if self.extra < other.extra:
-            return True
-        else:
-            return False
+# Parsed versions, by version string.
+versionMemo = {}
 
-    def __eq__(self, other):
-        if main == other.main and minor == other.minor and extra == other.extra:
-            return True
-        return False
+# Return a version string as a (major, minor, extra) tuple of integers, which
+# compare in version order. Exit if the string is not a version.
+def parseVersion(stringVersion):
+    if stringVersion in versionMemo:
+        return versionMemo[stringVersion]
+    verList = stringVersion.split('.')
+    try:
+        if len(verList) < 2 or len(verList) > 3:
+            raise ValueError(stringVersion)
+        version = tuple([int(n) for n in verList] + [0] * (3 - len(verList)))
+    except ValueError:
+        print('Wrong version :' + stringVersion)
+        sys.exit(1)
+    versionMemo[stringVersion] = version
+    return version
 
 builtin_aarch64 = {
     "triple" : "aarch64-linux-gnu",
@@ -117,25 +156,642 @@ builtinTarget = {
     "aarch64eb" : builtin_aarch64eb,
 }
 
+# Released versions of the packages known to build toolchains.
+knownVersions = {
+    "binutils" : ["2.23", "2.23.1", "2.23.2", "2.24"],
+    "gcc"      : ["4.8.0", "4.8.1", "4.8.2", "4.8.3"],
+    "glibc"    : ["2.17", "2.18", "2.19"],
+    "linux"    : ["3.7", "3.8.13", "3.9.4", "3.10", "3.12"],
+}
+
+# Requirements between packages, besides the minimum versions of each
+# builtin target: (package, version, other package, minimum version) reads
+# 'package >= version needs other package >= minimum version'.
+versionRules = [
+    ("glibc", "2.18", "binutils", "2.20"),
+    ("glibc", "2.18", "gcc", "4.3"),
+    ("glibc", "2.19", "binutils", "2.20"),
+    ("glibc", "2.19", "gcc", "4.3"),
+]
+
+versionPackages = ["binutils", "gcc", "glibc", "linux"]
+
+# The versions each builtin target accepts and their valid combinations,
+# computed once. A combination is a tuple of version strings in the order
+# of versionPackages.
+class VersionIndex:
+    def __init__(self, targets, versions, rules):
+        self.rules = [(package, parseVersion(version), other, parseVersion(minimum))
+                      for package, version, other, minimum in rules]
+        self.versions = {}
+        self.combos   = {}
+        self.valid    = {}
+        for builtin, config in targets.items():
+            self.versions[builtin] = {}
+            for package in versionPackages:
+                accepted = [v for v in versions[package]
+                            if parseVersion(v) >= parseVersion(config[package])]
+                # The default versions are known good even if not listed.
+                default = config['default-' + package]
+                if default not in accepted:
+                    accepted.append(default)
+                accepted.sort(key=parseVersion)
+                self.versions[builtin][package] = accepted
+            combos = []
+            for combo in self.product(builtin, versionPackages):
+                if self.satisfied(dict(zip(versionPackages, combo))):
+                    combos.append(combo)
+            self.combos[builtin] = combos
+            self.valid[builtin]  = set(combos)
+
+    def product(self, builtin, packages):
+        if not packages:
+            return [()]
+        tails = self.product(builtin, packages[1:])
+        return [(version,) + tail for version in self.versions[builtin][packages[0]]
+                for tail in tails]
+
+    def satisfied(self, combo):
+        for package, version, other, minimum in self.rules:
+            if parseVersion(combo[package]) >= version and parseVersion(combo[other]) < minimum:
+                return False
+        return True
+
+    # The versions of a package a builtin target accepts, within [low, high]
+    # when given.
+    def range(self, builtin, package, low='', high=''):
+        versions = self.versions[builtin][package]
+        keys = [parseVersion(version) for version in versions]
+        start = 0
+        end   = len(versions)
+        if low != '':
+            start = bisect.bisect_left(keys, parseVersion(low))
+        if high != '':
+            end = bisect.bisect_right(keys, parseVersion(high))
+        return versions[start:end]
+
+    # True if the versions of a {package: version} dictionary meet the
+    # minimum versions of the builtin target and the rules, even if some of
+    # them are not known.
+    def accepts(self, builtin, versions):
+        config = builtinTarget[builtin]
+        for package in versionPackages:
+            if parseVersion(versions[package]) < parseVersion(config[package]):
+                return False
+        return self.satisfied(versions)
+
+    # True if the versions of a {package: version} dictionary are a known
+    # good combination for the builtin target.
+    def known(self, builtin, versions):
+        return tuple([versions[package] for package in versionPackages]) in self.valid[builtin]
+
+    # Every valid combination, as {package: version} dictionaries.
+    def combinations(self, builtin):
+        return [dict(zip(versionPackages, combo)) for combo in self.combos[builtin]]
+
+versionIndex = VersionIndex(builtinTarget, knownVersions, versionRules)
+
+# Serialize messages printed from concurrent workers.
+printLock = threading.Lock()
+
+def printMessage(msg):
+    printLock.acquire()
+    try:
+        buildLogs.clearProgress()
+        sys.stdout.write(msg + '\n')
+        sys.stdout.flush()
+    finally:
+        printLock.release()
+
 def checkReturnCode(ret, msg):
     if ret != 0:
         print('Error!')
         print('Message :' + msg)
         sys.exit(1)
 
-def checkStrVersion(minVersion, curVersion):
-    #print(minVersion + ' ' + curVersion)
-    minVerList = minVersion.split('.')
-    curVerList = curVersion.split('.')
-    if len(curVerList) > 3:
-        print('Wrong version :' + curVersion)
-        sys.exit(1)
-    i = 0;
-    while i < len(minVerList) and i < 3:
-        if int(minVerList[i]) > int(curVerList[i]):
+# Resource usage of one step (configure, make, install...) of a stage.
+class StepRecord:
+    def __init__(self, stage, step, wall, usage, jobs=0):
+        self.stage  = stage
+        self.step   = step
+        self.wall   = wall
+        # Make jobs granted to the stage, 0 outside of a stage.
+        self.jobs   = jobs
+        self.user   = usage.ru_utime
+        self.sys    = usage.ru_stime
+        # ru_maxrss is in kilobytes on Linux, blocks are 512 bytes.
+        self.maxrss = usage.ru_maxrss * 1024
+        self.read   = usage.ru_inblock * 512
+        self.write  = usage.ru_oublock * 512
+
+    def toDict(self):
+        return {'stage': self.stage, 'step': self.step, 'wall': self.wall,
+                'jobs': self.jobs, 'user': self.user, 'sys': self.sys, 'maxrss': self.maxrss,
+                'read': self.read, 'write': self.write}
+
+reportFields = ['stage', 'step', 'wall', 'jobs', 'user', 'sys', 'maxrss', 'read', 'write']
+
+# Collect the resource usage of every step run by the bot.
+class BuildReport:
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        self.lock.acquire()
+        self.records.append(record)
+        self.lock.release()
+
+    # Write the records as CSV if the file name ends with '.csv', as JSON
+    # otherwise.
+    def write(self, path):
+        f = open(path, 'w')
+        try:
+            if path.endswith('.csv'):
+                writer = csv.writer(f)
+                writer.writerow(reportFields)
+                for record in self.records:
+                    writer.writerow([record.toDict()[field] for field in reportFields])
+            else:
+                json.dump([record.toDict() for record in self.records], f, indent=2)
+        finally:
+            f.close()
+
+    def summary(self):
+        def size(n):
+            return '%.1fM' % (n / 1048576.0)
+        def line(stage, step, wall, user, sys, maxrss, read, write):
+            return ('%-20s %-32s %9s %9s %9s %9s %9s %9s' %
+                    (stage, step, wall, user, sys, maxrss, read, write))
+        lines = [line('Stage', 'Step', 'Wall', 'User', 'Sys', 'MaxRSS', 'Read', 'Write')]
+        for r in self.records:
+            lines.append(line(r.stage, r.step, '%.1fs' % r.wall, '%.1fs' % r.user,
+                              '%.1fs' % r.sys, size(r.maxrss), size(r.read),
+                              size(r.write)))
+        # The steps of concurrent stages overlap, so no wall time total.
+        lines.append(line('Total', '', '',
+                          '%.1fs' % sum([r.user for r in self.records]),
+                          '%.1fs' % sum([r.sys for r in self.records]),
+                          size(max([0] + [r.maxrss for r in self.records])),
+                          size(sum([r.read for r in self.records])),
+                          size(sum([r.write for r in self.records]))))
+        return '\n'.join(lines)
+
+buildReport = BuildReport()
+
+# Output of the commands of every stage, written to one gzip file per stage
+# instead of the terminal. The last lines of every stage are kept to be shown
+# if it fails, and a progress line tells what the running stages do.
+class BuildLogs:
+    tailLines = 40
+    # Seconds between two progress lines, on a terminal and elsewhere.
+    ttyInterval  = 1
+    fileInterval = 60
+
+    def __init__(self):
+        self.directory = ''
+        self.lock    = threading.Lock()
+        self.tails   = {}
+        # Step and start time of the command run by each stage.
+        self.running = {}
+        self.opened  = set()
+        # Open log file of each stage and the number of commands writing it.
+        self.files   = {}
+        self.shown   = False
+        self.tty     = sys.stdout.isatty()
+
+    def path(self, stage):
+        return self.directory + '/' + stage.replace(':', '-') + '.log.gz'
+
+    # Open the log of 'stage' for the output of 'step', return a StageLog.
+    def open(self, stage, step):
+        self.lock.acquire()
+        try:
+            # The first command of a stage replaces the log of the previous
+            # build, the next ones append a gzip member to it.
+            mode = 'ab'
+            if stage not in self.opened:
+                mode = 'wb'
+                self.opened.add(stage)
+                self.tails[stage] = collections.deque(maxlen=self.tailLines)
+            self.running[stage] = (step, time.time())
+            tail = self.tails[stage]
+            # Commands of a stage run at the same time share the file, their
+            # output is interleaved as with make -j.
+            if stage not in self.files:
+                self.files[stage] = [gzip.open(self.path(stage), mode), 0, threading.Lock()]
+            self.files[stage][1] += 1
+            log = self.files[stage]
+        finally:
+            self.lock.release()
+        return StageLog(self, stage, step, log, tail)
+
+    # Write the chunks returned by 'read' to the log of 'stage' until it
+    # returns an empty string.
+    def record(self, read, stage, step):
+        log = self.open(stage, step)
+        try:
+            while True:
+                data = read()
+                if not data:
+                    break
+                log.write(data)
+        finally:
+            log.close()
+
+    def tail(self, stage):
+        return list(self.tails.get(stage, []))
+
+    # Erase the progress line so that a message can be printed, the caller
+    # holds printLock.
+    def clearProgress(self):
+        if self.shown:
+            sys.stdout.write('\r\033[K')
+            self.shown = False
+
+    def progress(self):
+        now = time.time()
+        self.lock.acquire()
+        try:
+            items = []
+            for stage in sorted(self.running.keys()):
+                step, start = self.running[stage]
+                items.append('%s %s %ds' % (stage, step, now - start))
+        finally:
+            self.lock.release()
+        if not items:
+            return
+        line = '[' + '] ['.join(items) + ']'
+        printLock.acquire()
+        try:
+            if self.tty:
+                width = int(os.environ.get('COLUMNS', '80')) - 1
+                sys.stdout.write('\r\033[K' + line[:width])
+                self.shown = True
+            else:
+                sys.stdout.write(line + '\n')
+            sys.stdout.flush()
+        finally:
+            printLock.release()
+
+    def startProgress(self):
+        interval = self.tty and self.ttyInterval or self.fileInterval
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.progress()
+        thread = threading.Thread(target=loop)
+        thread.daemon = True
+        thread.start()
+
+# The output of one command in the log of its stage. It is written in large
+# chunks as it comes, not line by line, the last lines are kept.
+class StageLog:
+    def __init__(self, logs, stage, step, log, tail):
+        self.logs    = logs
+        self.stage   = stage
+        self.log     = log
+        self.tail    = tail
+        self.partial = ''
+        self.write('### ' + step + '\n')
+
+    def write(self, data):
+        self.log[2].acquire()
+        try:
+            self.log[0].write(data)
+        finally:
+            self.log[2].release()
+        lines = (self.partial + data).replace('\r', '\n').split('\n')
+        self.partial = lines.pop()
+        self.tail.extend(lines)
+
+    def close(self):
+        if self.partial != '':
+            self.tail.append(self.partial)
+        self.logs.lock.acquire()
+        try:
+            self.log[1] -= 1
+            if self.log[1] == 0:
+                self.log[0].close()
+                del self.logs.files[self.stage]
+                del self.logs.running[self.stage]
+        finally:
+            self.logs.lock.release()
+
+buildLogs = BuildLogs()
+
+# Name of the scheduler stage run by the current thread.
+stageContext = threading.local()
+
+def currentStage(default):
+    return getattr(stageContext, 'name', default)
+
+# Wait for a process, return its exit code and resource usage.
+def waitProcess(proc):
+    while True:
+        try:
+            pid, status, usage = os.wait4(proc.pid, 0)
+            break
+        except OSError, exc:
+            if exc.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, usage
+
+# Resource usage of a command run by another host or never started, with the
+# fields of the resource module used by StepRecord.
+RemoteUsage = collections.namedtuple('RemoteUsage',
+                                     'ru_utime ru_stime ru_maxrss ru_inblock ru_oublock')
+
+noUsage = RemoteUsage(0, 0, 0, 0, 0)
+
+# A command run by the ProcessEngine.
+class EngineJob:
+    def __init__(self, proc, stage, step, output, timeout):
+        self.proc    = proc
+        self.stage   = stage
+        self.step    = step
+        # Called with every chunk of output, from the engine thread.
+        self.output  = output
+        self.fd      = None
+        # Since when the command has no output pipe to wait on.
+        self.quiet   = time.time()
+        if proc is not None and proc.stdout is not None:
+            self.fd = proc.stdout.fileno()
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.timeout  = timeout
+        self.deadline = 0
+        if timeout > 0:
+            self.deadline = time.time() + timeout
+        # Why the command was killed, and when.
+        self.killed   = ''
+        self.killTime = 0
+        self.result   = None
+        self.done     = threading.Event()
+
+    # Wait for the command, return its exit code and resource usage.
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+# Run the commands of all the stages from one thread: a select() loop
+# multiplexes their output into the stage logs, reaps them, kills the ones
+# running over the timeout of their step, and cancels the commands of stages
+# on request. Every command has its own process group, killing it kills the
+# make and compiler processes below it too.
+class ProcessEngine:
+    tick  = 0.25
+    # A command usually exits right after closing its output, it is looked
+    # for more often for a second.
+    quickTick = 0.01
+    # Seconds between SIGTERM and SIGKILL.
+    grace = 10
+
+    def __init__(self):
+        self.lock   = threading.Lock()
+        self.jobs   = []
+        # Stages whose commands are cancelled, with the reason, '*' for all.
+        self.cancelled = {}
+        # Functions cancelling the commands a stage runs elsewhere.
+        self.cancellers = {}
+        # Timeout in seconds by step name or first word of it, '' for the
+        # other steps.
+        self.timeouts = {}
+        self.thread = None
+
+    def timeout(self, step):
+        for name in [step, step.split(' ')[0], '']:
+            if name in self.timeouts:
+                return self.timeouts[name]
+        return 0
+
+    # Drop the cancellation of the stages 'stages' and of all the stages,
+    # once the build they belong to is over.
+    def forget(self, stages):
+        self.lock.acquire()
+        try:
+            for name in stages + ['*']:
+                self.cancelled.pop(name, None)
+        finally:
+            self.lock.release()
+
+    # Why the commands of 'stage' are cancelled, '' if they are not.
+    def cancelReason(self, stage):
+        return self.cancelled.get(stage, self.cancelled.get('*', ''))
+
+    # Start a command of 'stage' and return its EngineJob. Its output goes to
+    # 'output' if given, to the terminal otherwise.
+    def submit(self, args, stage, step, cwd=None, env=None, output=None, timeout=0):
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.wakeRead, self.wakeWrite = os.pipe()
+                self.thread = threading.Thread(target=self.loop)
+                self.thread.daemon = True
+                self.thread.start()
+            if self.cancelReason(stage) != '':
+                job = EngineJob(None, stage, step, output, 0)
+                job.killed = self.cancelReason(stage)
+                job.result = (-signal.SIGTERM, noUsage)
+                job.done.set()
+                return job
+            stdout = None
+            if output is not None:
+                stdout = subprocess.PIPE
+            proc = subprocess.Popen(args, cwd=cwd, env=env, stdout=stdout,
+                                    stderr=stdout and subprocess.STDOUT,
+                                    preexec_fn=os.setpgrp)
+            job = EngineJob(proc, stage, step, output, timeout)
+            self.jobs.append(job)
+        finally:
+            self.lock.release()
+        os.write(self.wakeWrite, 'x')
+        return job
+
+    # Kill the commands of the stages 'stages', all of them if None, and the
+    # ones they start from now on.
+    def cancel(self, stages, reason):
+        self.lock.acquire()
+        try:
+            if stages is None:
+                stages = ['*']
+            for name in stages:
+                self.cancelled[name] = reason
+            jobs = [job for job in self.jobs
+                    if '*' in stages or job.stage in stages]
+            cancellers = [func for name, func in self.cancellers.items()
+                          if '*' in stages or name in stages]
+        finally:
+            self.lock.release()
+        for job in jobs:
+            self.kill(job, reason)
+        for func in cancellers:
+            func()
+
+    # Call 'func' to cancel the command 'stage' runs elsewhere, until unwatch().
+    def watch(self, stage, func):
+        self.lock.acquire()
+        self.cancellers[stage] = func
+        self.lock.release()
+        if self.cancelReason(stage) != '':
+            func()
+
+    def unwatch(self, stage):
+        self.lock.acquire()
+        self.cancellers.pop(stage, None)
+        self.lock.release()
+
+    def kill(self, job, reason):
+        if job.killed != '':
+            return
+        job.killed = reason
+        job.killTime = time.time()
+        try:
+            os.killpg(job.proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def loop(self):
+        while True:
+            self.lock.acquire()
+            jobs = list(self.jobs)
+            self.lock.release()
+            fds = [self.wakeRead] + [job.fd for job in jobs if job.fd is not None]
+            timeout = self.tick
+            if [job for job in jobs if job.fd is None and time.time() - job.quiet < 1]:
+                timeout = self.quickTick
+            try:
+                readable = select.select(fds, [], [], timeout)[0]
+            except select.error, exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wakeRead in readable:
+                os.read(self.wakeRead, 4096)
+            now = time.time()
+            for job in jobs:
+                if job.fd is not None and job.fd in readable:
+                    self.read(job)
+                if self.reap(job):
+                    continue
+                if job.deadline != 0 and now > job.deadline:
+                    self.kill(job, 'timeout after ' + str(job.timeout) + 's')
+                if job.killed != '' and now - job.killTime > self.grace:
+                    try:
+                        os.killpg(job.proc.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+
+    # Read the output available, return False once there is no more for now.
+    def read(self, job):
+        try:
+            data = os.read(job.fd, 65536)
+        except OSError, exc:
+            if exc.errno in [errno.EAGAIN, errno.EINTR]:
+                return False
+            data = ''
+        if not data:
+            job.proc.stdout.close()
+            job.fd = None
+            job.quiet = time.time()
             return False
-        i = i + 1
-    return True
+        try:
+            job.output(data)
+        except Exception:
+            # Nobody takes the output any more.
+            self.kill(job, 'output failed')
+        return True
+
+    # Finish the job if its command exited. The output left in the pipe is
+    # read, a background process still holding it does not keep the job.
+    def reap(self, job):
+        try:
+            pid, status, usage = os.wait4(job.proc.pid, os.WNOHANG)
+        except OSError, exc:
+            if exc.errno == errno.EINTR:
+                return False
+            pid, status, usage = job.proc.pid, 255 << 8, noUsage
+        if pid == 0:
+            return False
+        while job.fd is not None and self.read(job):
+            pass
+        if job.fd is not None:
+            job.proc.stdout.close()
+            job.fd = None
+        if os.WIFSIGNALED(status):
+            job.proc.returncode = -os.WTERMSIG(status)
+        else:
+            job.proc.returncode = os.WEXITSTATUS(status)
+        job.result = (job.proc.returncode, usage)
+        self.lock.acquire()
+        self.jobs.remove(job)
+        self.lock.release()
+        job.done.set()
+        return True
+
+processEngine = ProcessEngine()
+
+# Run the commands of the stages on this host. A stage run by another host
+# gets the trees it reads pushed to that host before it runs, and the files
+# it installed pulled back once done, see WorkerExecutor.
+class LocalExecutor:
+    name = 'local'
+
+    # Run a command of 'stage', return its exit code and resource usage.
+    def run(self, args, stage, step, cwd=None, env=None):
+        if env is None:
+            env = baseEnv()
+        log = None
+        if buildLogs.directory != '':
+            log = buildLogs.open(stage, step)
+        try:
+            job = processEngine.submit(args, stage, step, cwd, env, log and log.write,
+                                       processEngine.timeout(step))
+            ret, usage = job.wait()
+        finally:
+            if log is not None:
+                log.close()
+        if job.killed != '':
+            printMessage('Kill ' + step + ' ' + stage + ' : ' + job.killed)
+        return ret, usage
+
+    def push(self, root, excludes=[]):
+        pass
+
+    def pull(self, root, excludes=[]):
+        pass
+
+localExecutor = LocalExecutor()
+
+# Executor of the stage run by the current thread.
+def currentExecutor():
+    return getattr(stageContext, 'executor', localExecutor)
+
+# Run an external command for a build stage, exit if it fails. Empty
+# arguments (options turned off) are dropped. The output goes to the log of
+# the stage when there is a log directory, the end of it is shown if the
+# command fails. The command runs on the host the stage was given to. With
+# check False the exit code is returned and failing is left to the caller.
+def runCommand(args, stage, step, cwd=None, env=None, check=True):
+    args = [arg for arg in args if arg != '']
+    stage = currentStage(stage)
+    start = time.time()
+    ret, usage = currentExecutor().run(args, stage, step, cwd, env)
+    buildReport.add(StepRecord(stage, step, time.time() - start, usage,
+                               getattr(stageContext, 'jobs', 0)))
+    if not check:
+        return ret
+    if ret != 0 and buildLogs.directory != '':
+        printMessage('\n'.join(['Last lines of ' + buildLogs.path(stage) + ' :'] +
+                                buildLogs.tail(stage)))
+    checkReturnCode(ret, step + ' ' + stage)
+
+def checkStrVersion(minVersion, curVersion):
+    return parseVersion(minVersion) <= parseVersion(curVersion)
 
 def checkVersion(buildConfig, config):
     if not checkStrVersion(config['gcc'], buildConfig.gcc):
@@ -151,8 +807,18 @@ def checkVersion(buildConfig, config):
         print('Current version of linux do not work!')
         sys.exit(1)
 
-def useBuiltinConfig(buildConfig, cmdopt):
-    config = builtinTarget[cmdopt.builtin]
+# Warn when the versions of a builtin target were never checked together.
+def checkCombination(buildConfig, builtin):
+    versions = {'binutils': buildConfig.binutils, 'gcc': buildConfig.gcc,
+                'glibc': buildConfig.glibc, 'linux': buildConfig.linux}
+    if not versionIndex.known(builtin, versions):
+        printMessage('Warning : binutils-' + buildConfig.binutils + ', gcc-' +
+                     buildConfig.gcc + ', glibc-' + buildConfig.glibc + ' and linux-' +
+                     buildConfig.linux + ' are not a known good combination for ' +
+                     builtin + '.')
+
+def useBuiltinConfig(buildConfig, builtin):
+    config = builtinTarget[builtin]
     if buildConfig.gcc == '':
         buildConfig.gcc = config['default-gcc']
     if buildConfig.glibc == '':
@@ -162,18 +828,26 @@ def useBuiltinConfig(buildConfig, cmdopt):
     if buildConfig.binutils == '':
         buildConfig.binutils = config['default-binutils']
     checkVersion(buildConfig, config)
+    checkCombination(buildConfig, builtin)
 
     buildConfig.triple = config['triple']
     buildConfig.kernel_header = config['kernel_header']
 
 def configureBuildOptions(buildConfig, cmdopt):
     buildConfig.options.jobs = '-j' + str(cmdopt.jobs)
+    buildConfig.options.incremental = cmdopt.incremental
+    if cmdopt.launcher != '':
+        buildConfig.options.launcher = cmdopt.launcher
+        launcherDir = cmdopt.launcherDir
+        if launcherDir == '':
+            launcherDir = buildConfig.workdir + '/' + os.path.basename(cmdopt.launcher)
+        # Every toolchain has its own cache.
+        buildConfig.options.launcherDir = os.path.abspath(launcherDir + '/' + buildConfig.triple)
     buildConfig.options.target = '--target=' + buildConfig.triple
     buildConfig.options.libhost = '--host=' + buildConfig.triple
     buildConfig.options.prefix = '--prefix=' + buildConfig.prefix
-    if cmdopt.sysroot == '':
-        cmdopt.sysroot = True
-    if cmdopt.sysroot == True:
+    # The sysroot is on unless turned off.
+    if cmdopt.sysroot != False:
         buildConfig.sysroot = buildConfig.prefix + '/fakeroot'
         buildConfig.options.sysroot = '--with-sysroot=' + buildConfig.prefix + '/fakeroot'
         buildConfig.options.libpath = buildConfig.sysroot + '/usr'
@@ -183,9 +857,11 @@ def configureBuildOptions(buildConfig, cmdopt):
         buildConfig.options.libpath = buildConfig.prefix
         buildConfig.options.libprefix = buildConfig.options.prefix
 
-def configureTarget(buildConfig, cmdopt):
-    if cmdopt.builtin != '':
-        useBuiltinConfig(buildConfig, cmdopt)
+# Configure the target 'builtin', the toolchain is installed into the sub
+# directory 'subdir' of the prefix if given.
+def configureTarget(buildConfig, cmdopt, builtin, subdir=''):
+    if builtin != '':
+        useBuiltinConfig(buildConfig, builtin)
     else:
         print('error now')
         print(buildConfig.target)
@@ -202,332 +878,2622 @@ def configureTarget(buildConfig, cmdopt):
         buildConfig.prefix = cmdopt.prefix
     elif buildConfig.prefix == '':
         buildConfig.prefix = buildConfig.workdir + '/' + 'install'
+    if subdir != '':
+        buildConfig.prefix = buildConfig.prefix + '/' + subdir
 
     buildConfig.workdir = os.path.abspath(buildConfig.workdir)
     buildConfig.prefix = os.path.abspath(buildConfig.prefix)
 
     configureBuildOptions(buildConfig, cmdopt)
 
-def buildBinutils(buildConfig):
-    cwd = os.getcwd()
-
-    build = buildConfig.build + '/build-binutils'
+# Create an empty build directory, remove the old one if it exists.
+def makeBuildDir(build, stage):
     if os.path.exists(build):
         shutil.rmtree(build)
     try:
         os.mkdir(build)
-        os.chdir(build)
     except:
-        print('Error when building binutils.')
+        print('Error when building ' + stage + '.')
         sys.exit(1)
-    configScript = buildConfig.src_binutils + '/configure'
-    ret = subprocess.call([configScript, buildConfig.options.target,
-                           buildConfig.options.prefix,
-                           buildConfig.options.sysroot
-                          ])
-    checkReturnCode(ret, 'configure binutils')
-    ret = subprocess.call(['make', buildConfig.options.jobs])
-    checkReturnCode(ret, 'make binutils')
-    ret = subprocess.call(['make', 'install'])
-    checkReturnCode(ret, 'install binutils')
-
-    os.chdir(cwd)
-
-def buildGccPass1(buildConfig):
-    cwd = os.getcwd()
-    build = buildConfig.build + '/build-gcc1'
-    if os.path.exists(build):
-        shutil.rmtree(build)
+
+# Size of the object trees, used until the real size has been measured.
+scratchEstimate = {
+    'build-binutils' : 600 << 20,
+    'build-gcc1'     : 1200 << 20,
+    'build-glibc'    : 1200 << 20,
+    'build-gcc2'     : 3000 << 20,
+}
+
+# Return the available memory in bytes, 0 if unknown.
+def memAvailable():
     try:
-        os.mkdir(build)
-        os.chdir(build)
-    except:
-        print('Error when building gcc pass 1.')
-        sys.exit(1)
-    configScript = buildConfig.src_gcc + '/configure'
+        f = open('/proc/meminfo')
+        try:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return 0
+
+# Return the type of the filesystem holding 'path'.
+def filesystemType(path):
+    fsType = ''
+    mountPoint = ''
+    try:
+        f = open('/proc/mounts')
+        try:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                if ((path + '/').startswith(fields[1].rstrip('/') + '/') and
+                        len(fields[1]) > len(mountPoint)):
+                    mountPoint, fsType = fields[1], fields[2]
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return fsType
+
+def treeSize(path):
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                size = size + os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return size
+
+# Fast local storage (tmpfs, local SSD) for the object trees. An object tree
+# goes there if the space left, minus the space of the other running stages,
+# holds its expected size; for tmpfs half of the available memory is left to
+# the compilers. The trees are removed once installed.
+class ScratchSpace:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.lock = threading.Lock()
+        self.reserved = {}
+        self.tmpfs = filesystemType(self.path) == 'tmpfs'
+        # Measured sizes of the object trees.
+        self.sizes = {}
+        try:
+            f = open(self.path + '/sizes.json')
+            try:
+                self.sizes = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+
+    def available(self):
+        st = os.statvfs(self.path)
+        free = st.f_bavail * st.f_frsize
+        if self.tmpfs:
+            free = min(free, memAvailable() // 2)
+        return free
 
-    ret = subprocess.call([configScript, buildConfig.options.target,
-                           buildConfig.options.prefix,
-                           buildConfig.options.sysroot,
+    # Return the scratch directory for the object tree 'build', or 'build'
+    # itself if the scratch space is short.
+    def allocate(self, build):
+        name = os.path.basename(build)
+        need = self.sizes.get(name, scratchEstimate.get(name, 1 << 30))
+        path = (self.path + '/' + hashlib.sha1(build).hexdigest()[:12] + '-' + name)
+        self.lock.acquire()
+        try:
+            if need + sum(self.reserved.values()) > self.available():
+                printMessage('Scratch space is short, build ' + name + ' in ' + build)
+                return build
+            self.reserved[path] = need
+        finally:
+            self.lock.release()
+        return path
+
+    # Record the size of an object tree, and remove it unless 'keep'. The
+    # tree of a failed build tells nothing of the size, it is not recorded.
+    def release(self, path, keep=False, failed=False):
+        name = os.path.basename(path).split('-', 1)[1]
+        size = treeSize(path)
+        self.lock.acquire()
+        try:
+            self.reserved.pop(path, None)
+            if not failed:
+                self.sizes[name] = max(size, self.sizes.get(name, 0))
+            f = open(self.path + '/sizes.json', 'w')
+            try:
+                json.dump(self.sizes, f)
+            finally:
+                f.close()
+        finally:
+            self.lock.release()
+        if not keep and os.path.exists(path):
+            shutil.rmtree(path)
+
+# Return the object directory 'name' of a stage, in the scratch space if
+# there is one.
+def allocateBuildDir(buildConfig, name):
+    build = buildConfig.build + '/' + name
+    if buildConfig.options.scratch is None:
+        return build
+    return buildConfig.options.scratch.allocate(build)
+
+# Give back an object directory once the stage is installed or has failed.
+def releaseBuildDir(buildConfig, build, failed=False):
+    scratch = buildConfig.options.scratch
+    if scratch is not None and build.startswith(scratch.path + '/'):
+        scratch.release(build, buildConfig.options.incremental, failed)
+
+# File recording how a build directory was configured.
+stampName = '.toolchainbot-stamp'
+
+# The configure command line, the compilers and the source tree it runs on,
+# the configure script stands for the source tree so that local patches to
+# other source files keep the build directory.
+def configureStamp(configure, env=None):
+    script = os.stat(configure[0])
+    if env is None:
+        env = os.environ
+    return {'configure': configure,
+            'compilers': [env.get('CC', ''), env.get('CXX', '')],
+            'script': [script.st_size, script.st_mtime]}
+
+def readStamp(build):
+    try:
+        f = open(build + '/' + stampName)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+
+def writeStamp(build, configure, env=None):
+    f = open(build + '/' + stampName, 'w')
+    try:
+        json.dump(configureStamp(configure, env), f)
+    finally:
+        f.close()
+
+# Prepare the build directory of a stage, return True if it has to be
+# configured. In incremental mode a directory configured by the same command
+# on the same source tree is kept, so make only rebuilds what changed.
+def prepareBuildDir(buildConfig, build, stage, configure, env=None):
+    if buildConfig.options.incremental and os.path.exists(build):
+        stamp = readStamp(build)
+        if stamp == configureStamp(configure, env):
+            printMessage('Reuse ' + build)
+            return False
+    makeBuildDir(build, stage)
+    return True
+
+# Run the configure command of a stage and record it in the stamp file.
+def runConfigure(configure, stage, build, env=None):
+    runCommand(configure, stage, 'configure', cwd=build, env=env)
+    writeStamp(build, configure, env)
+
+# Build an autotools package in the object directory 'name': the first of
+# the (step, argv) 'steps' is configure, run unless the directory can be
+# reused, the other ones run in order.
+def buildAutotools(buildConfig, stage, name, steps, env):
+    executor = currentExecutor()
+    if executor is not localExecutor:
+        # Another host always builds from scratch, in its own object directory.
+        build = buildConfig.build + '/' + name
+        executor.fresh(build, stage)
+        for step, args in steps:
+            runCommand(args, stage, step, cwd=build, env=env)
+        return
+    build = allocateBuildDir(buildConfig, name)
+    failed = True
+    try:
+        configure = steps[0][1]
+        if prepareBuildDir(buildConfig, build, stage, configure, env):
+            runConfigure(configure, stage, build, env)
+        for step, args in steps[1:]:
+            runCommand(args, stage, step, cwd=build, env=env)
+        failed = False
+    finally:
+        releaseBuildDir(buildConfig, build, failed)
+
+def binutilsConfigure(buildConfig):
+    return [buildConfig.src_binutils + '/configure',
+            buildConfig.options.target,
+            buildConfig.options.prefix,
+            buildConfig.options.sysroot]
+
+def binutilsSteps(buildConfig, jobs):
+    return [('configure', binutilsConfigure(buildConfig)),
+            ('make', ['make', jobs]),
+            ('install', ['make', 'install'])]
+
+def buildBinutils(buildConfig, jobs=''):
+    if jobs == '':
+        jobs = buildConfig.options.jobs
+    buildAutotools(buildConfig, 'binutils', 'build-binutils',
+                   binutilsSteps(buildConfig, jobs), stageEnv(buildConfig, tools=False))
+
+def gccPass1Configure(buildConfig):
+    return [buildConfig.src_gcc + '/configure',
+            buildConfig.options.target,
+            buildConfig.options.prefix,
+            buildConfig.options.sysroot,
             '--enable-languages=c', '--disable-shared', '--disable-nls', '--disable-threads',
             '--disable-libssp', '--without-headers', '--disable-decimal-float',
             '--disable-libgomp', '--disable-libmudflap', '--disable-multilib',
-            '--with-gnu-ld', '--with-gnu-as', '--with-newlib'])
-    checkReturnCode(ret, 'configure gcc pass 1')
-    ret = subprocess.call(['make','all-gcc' ,'all-target-libgcc' , buildConfig.options.jobs])
-    checkReturnCode(ret, 'make gcc pass 1')
-    ret = subprocess.call(['make', 'install-gcc', 'install-target-libgcc'])
-    checkReturnCode(ret, 'install gcc pass 1')
+            '--with-gnu-ld', '--with-gnu-as', '--with-newlib']
 
-    os.chdir(cwd)
+def gccPass1Steps(buildConfig, jobs):
+    return [('configure', gccPass1Configure(buildConfig)),
+            ('make', ['make','all-gcc' ,'all-target-libgcc' , jobs]),
+            ('install', ['make', 'install-gcc', 'install-target-libgcc'])]
 
-def installKernelHeader(buildConfig):
-    cwd = os.getcwd()
-    os.chdir(buildConfig.src_linux)
-    ret = subprocess.call(['make', 'mrproper'])
-    checkReturnCode(ret, 'make mrproper')
-    ret = subprocess.call(['make', 'ARCH='+buildConfig.kernel_header, 'headers_check'])
-    checkReturnCode(ret, 'make headers check')
+def buildGccPass1(buildConfig, jobs=''):
+    if jobs == '':
+        jobs = buildConfig.options.jobs
+    buildAutotools(buildConfig, 'gcc pass 1', 'build-gcc1',
+                   gccPass1Steps(buildConfig, jobs), stageEnv(buildConfig))
 
-    ret = subprocess.call(['make', 'ARCH='+buildConfig.kernel_header,
-                           'INSTALL_HDR_PATH='+buildConfig.options.libpath, 'headers_install'])
-    checkReturnCode(ret, 'install kernel header')
+# Object directory of the kernel header install of an architecture.
+def kernelHeaderBuild(buildConfig):
+    return buildConfig.build + '/build-linux-' + buildConfig.kernel_header
 
-    os.chdir(cwd)
+def kernelHeaderCheck(buildConfig):
+    return ['make', '-C', buildConfig.src_linux, 'O=' + kernelHeaderBuild(buildConfig),
+            'ARCH='+buildConfig.kernel_header, 'headers_check']
 
-def buildGlibc(buildConfig):
-    cwd = os.getcwd()
+def kernelHeaderInstall(buildConfig, path):
+    return ['make', '-C', buildConfig.src_linux, 'O=' + kernelHeaderBuild(buildConfig),
+            'ARCH='+buildConfig.kernel_header, 'INSTALL_HDR_PATH='+path, 'headers_install']
 
-    build = buildConfig.build + '/build-glibc'
-    if os.path.exists(build):
-        shutil.rmtree(build)
+# Directory the kernel headers of a linux version and architecture are
+# installed into once, and copied from into every toolchain using them. It
+# lives in the shared cache if there is one.
+def kernelHeaderDir(buildConfig):
+    name = 'headers-' + buildConfig.linux + '-' + buildConfig.kernel_header
+    if buildConfig.sharedCache != '':
+        return buildConfig.sharedCache + '/headers/' + name
+    return buildConfig.workdir + '/build/' + name
+
+# Install the kernel headers into 'path', in an object directory so the linux
+# source tree is left untouched. An installed header tree is complete and
+# checked, so it is reused as is.
+def installKernelHeader(buildConfig, path):
+    stage = 'kernel header'
+    if os.path.exists(path + '/.complete'):
+        printMessage('Reuse kernel headers ' + path)
+        return
+    lock = None
+    if buildConfig.sharedCache != '':
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        lock = FileLock(buildConfig.sharedCache + '/locks/' + os.path.basename(path) + '.lock')
+        lock.acquire()
     try:
-        os.mkdir(build)
-        os.chdir(build)
-    except:
-        print('Error when building glibc.')
-        sys.exit(1)
-    configScript = buildConfig.src_glibc + '/configure'
+        if os.path.exists(path + '/.complete'):
+            printMessage('Reuse kernel headers ' + path)
+            return
+        source = buildConfig.src_linux
+        if os.path.exists(source + '/.config') or os.path.exists(source + '/include/config'):
+            # kbuild refuses to use an object directory with a configured
+            # source tree.
+            runCommand(['make', 'mrproper'], stage, 'make mrproper', cwd=source)
+        build = kernelHeaderBuild(buildConfig)
+        makeBuildDir(build, stage)
+        runCommand(kernelHeaderCheck(buildConfig), stage, 'make headers check', cwd=build)
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        runCommand(kernelHeaderInstall(buildConfig, tmp), stage, 'install', cwd=build)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        open(path + '/.complete', 'w').close()
+        shutil.rmtree(build)
+    finally:
+        if lock is not None:
+            lock.release()
+
+def kernelHeaderCopy(buildConfig, path):
+    return ['cp', '-a', path + '/include', buildConfig.options.libpath + '/']
 
+# Copy the installed kernel headers into the toolchain.
+def copyKernelHeader(buildConfig, path):
+    libpath = buildConfig.options.libpath
+    if not os.path.exists(libpath):
+        os.makedirs(libpath)
+    runCommand(kernelHeaderCopy(buildConfig, path), 'kernel header', 'copy')
+
+def glibcConfigure(buildConfig):
     header = os.path.abspath(buildConfig.options.libpath + '/include')
     binutils = os.path.abspath(buildConfig.prefix + '/bin')
+    return [buildConfig.src_glibc + '/configure',
+            buildConfig.options.libhost,
+            buildConfig.options.libprefix,
+            '--enable-add-ons',
+            '--with-headers='+header,
+            '--with-binutils='+binutils]
 
-    ret = subprocess.call([configScript, buildConfig.options.libhost,
-                           buildConfig.options.libprefix,
-                           '--enable-add-ons',
-                           '--with-headers='+header,
-                           '--with-binutils='+binutils])
-    checkReturnCode(ret, 'configure glibc')
-    ret = subprocess.call(['make', buildConfig.options.jobs])
-    checkReturnCode(ret, 'make glibc')
+def glibcInstall(buildConfig):
     if buildConfig.options.sysroot == '':
-        ret = subprocess.call(['make', 'install'])
-    else:
-        ret = subprocess.call(['make', 'install',
-                               'install_root=' + buildConfig.sysroot])
-    checkReturnCode(ret, 'install glibc')
+        return ['make', 'install']
+    return ['make', 'install', 'install_root=' + buildConfig.sysroot]
 
-    os.chdir(cwd)
+def glibcSteps(buildConfig, jobs):
+    return [('configure', glibcConfigure(buildConfig)),
+            ('make', ['make', jobs]),
+            ('install', glibcInstall(buildConfig))]
 
-def buildGccPass2(buildConfig):
-    cwd = os.getcwd()
-    build = buildConfig.build + '/build-gcc2'
-    if os.path.exists(build):
-        shutil.rmtree(build)
-    try:
-        os.mkdir(build)
-        os.chdir(build)
-    except:
-        print('Error when building gcc pass 2.')
-        sys.exit(1)
-    configScript = buildConfig.src_gcc + '/configure'
+def buildGlibc(buildConfig, jobs=''):
+    if jobs == '':
+        jobs = buildConfig.options.jobs
+    buildAutotools(buildConfig, 'glibc', 'build-glibc',
+                   glibcSteps(buildConfig, jobs), stageEnv(buildConfig, target=True))
 
-    ret = subprocess.call([configScript, buildConfig.options.target,
-                           buildConfig.options.prefix,
-                           buildConfig.options.sysroot,
+def gccPass2Configure(buildConfig):
+    return [buildConfig.src_gcc + '/configure',
+            buildConfig.options.target,
+            buildConfig.options.prefix,
+            buildConfig.options.sysroot,
             '--enable-languages=c,c++', '--enable-shared', '--disable-nls', '--enable-c99',
-            '--enable-long-long', '--disable-multilib'])
-    checkReturnCode(ret, 'configure gcc pass 2')
-    ret = subprocess.call(['make', buildConfig.options.jobs])
-    checkReturnCode(ret, 'make gcc pass 2')
-    ret = subprocess.call(['make', 'install'])
-    checkReturnCode(ret, 'install gcc pass 2')
-
-    os.chdir(cwd)
-
-def hackMoveTo(current, target):
-    fname = 'ldscripts'
-    if os.path.exists(current + '/' + fname):
-        os.rename(current + '/' + fname, target + '/' + fname)
-    shutil.rmtree(current)
-
-# A library/include directory path hack, it's needed when sysroot was disable.
-def hackLibPath(buildConfig):
-    targetLib = os.path.abspath(buildConfig.prefix + '/' + buildConfig.triple)
-    rootLib   = os.path.abspath(buildConfig.prefix + '/lib')
-    rootLib64 = os.path.abspath(buildConfig.prefix + '/lib64')
-    include   = os.path.abspath(buildConfig.prefix + '/include')
-    cwd = os.getcwd()
-    try:
-        os.chdir(targetLib)
-        if os.path.exists('lib'):
-            hackMoveTo('lib', rootLib)
-        os.symlink('../lib', 'lib')
-        print(targetLib)
-        if os.path.exists('lib64'):
-            hackMoveTo('lib64', rootLib64)
-        os.symlink('../lib64', 'lib64')
-        if os.path.exists('include'):
-            hackMoveTo('include', include)
-        os.symlink('../include', 'include')
-    except:
-        print('Error when hacking lib path')
-        sys.exit(1)
-    os.chdir(cwd)
+            '--enable-long-long', '--disable-multilib']
 
-# Decompress source files tarball. 
-def decompress(tarball, build, source):
-    if os.path.exists(source):
-        print('Skip ' + source)
-        return
-    print('Uncompress ' + os.path.basename(tarball))
-    ret = subprocess.call(['tar', 'xf', tarball, '-C', build])
-    if ret == 0:
-        print('Done')
-    else:
-        print('Uncompress error!')
-        sys.exit(1)
+def gccPass2Steps(buildConfig, jobs):
+    return [('configure', gccPass2Configure(buildConfig)),
+            ('make', ['make', jobs]),
+            ('install', ['make', 'install'])]
 
-# Download the source files tarball from Internet, not implemented as you see.
-def downloadTarball(name, version, target):
-    return ''
+def buildGccPass2(buildConfig, jobs=''):
+    if jobs == '':
+        jobs = buildConfig.options.jobs
+    buildAutotools(buildConfig, 'gcc pass 2', 'build-gcc2',
+                   gccPass2Steps(buildConfig, jobs), stageEnv(buildConfig))
 
-# Prepare source files tarball, download them if needed.
-def getSourceTarball(name, version, downloads, build):
-    fullName = name + '-' + version
-    path = downloads + '/' + fullName + '.tar.bz2'
-    source = build + '/' + fullName
-    if os.path.exists(source):
-        return False, source
-    if os.path.exists(path):
-        return path, source
-    path = downloads + '/' + fullName + '.tar.xz'
-    if os.path.exists(path):
-        return path, source
-    path = downloads + '/' + fullName + '.tar.gz'
-    if os.path.exists(path):
-        return path, source
-    tarball = downloadTarball(name, version, downloads)
-    if not os.path.exists(tarball):
-        print('Error! Could not find :' + tarball)
-        print('name = ' + name + '; version = ' + version)
-        sys.exit(1)
-    return tarball, source
+# The directories of ${PREFIX}/${TARGET} merged into the prefix, as
+# (directory, directory it is merged into, symbolic link replacing it).
+def sysrootLayout(buildConfig):
+    prefix = os.path.abspath(buildConfig.prefix)
+    target = prefix + '/' + buildConfig.triple
+    return [(target + '/' + name, prefix + '/' + name, '../' + name)
+            for name in ['lib', 'lib64', 'include']]
 
-# Merge glibc-ports directory if needed.
-def mergeGlibcPorts(src_glibc, glibcVersion, downloads, build):
-    curVersion = SourceVersion(glibcVersion)
-    minVersion = SourceVersion('2.3.5')
-    maxVersion = SourceVersion('2.16.0')
-    if curVersion < minVersion or curVersion > maxVersion:
-        # Don't need merge 'ports' directory.
+sysrootManifestName = '.toolchainbot-sysroot.json'
+
+# Append to 'actions' the renames merging the directory 'source' into
+# 'target'. Sub directories on both sides are merged, a file on both sides is
+# kept in 'target'. Nothing is copied.
+def mergeActions(source, target, actions):
+    if not os.path.lexists(target):
+        actions.append(('move', source, target))
         return
-    tar_ports, src_ports = getSourceTarball('glibc-ports', glibcVersion, downloads, build)
-    decompress(tar_ports, build, src_ports)
-    shutil.move(src_ports, src_glibc)
+    for name in sorted(os.listdir(source)):
+        src = source + '/' + name
+        dst = target + '/' + name
+        if not os.path.lexists(dst):
+            actions.append(('move', src, dst))
+        elif (os.path.isdir(src) and not os.path.islink(src) and
+              os.path.isdir(dst) and not os.path.islink(dst)):
+            mergeActions(src, dst, actions)
+        else:
+            actions.append(('remove', src, dst))
+    actions.append(('rmdir', source, target))
 
-# Prepare source files directory of linux/binutils/gcc/glibc.
-def getSource(buildConfig):
-    downloads = buildConfig.workdir + '/' + 'downloads'
-    build     = buildConfig.workdir + '/' + 'build'
+# The actions giving the prefix its layout, as (action, path, other path),
+# none if it has it already.
+def sysrootActions(buildConfig):
+    actions = []
+    for source, target, link in sysrootLayout(buildConfig):
+        if os.path.islink(source):
+            if os.readlink(source) != link:
+                actions.append(('remove', source, target))
+                actions.append(('link', link, source))
+            continue
+        if os.path.isdir(source):
+            mergeActions(source, target, actions)
+        actions.append(('link', link, source))
+    return actions
+
+# Merge the lib, lib64 and include directories of ${PREFIX}/${TARGET} into the
+# prefix and link them there, in one pass of renames. A prefix with the layout
+# recorded in its manifest is left as is, the merge only runs again for the
+# directories a restored stage brought back.
+def finalizeSysroot(buildConfig):
+    prefix = os.path.abspath(buildConfig.prefix)
+    layout = sysrootLayout(buildConfig)
+    manifest = prefix + '/' + sysrootManifestName
     try:
-        if not os.path.exists(downloads):
-            os.mkdir(downloads)
-        if not os.path.exists(downloads):
-            os.mkdir(build)
-    except:
-        print('Error when creating directory!')
+        f = open(manifest)
+        try:
+            links = json.load(f)
+        finally:
+            f.close()
+        if links == [[source, link] for source, target, link in layout] and not [
+                source for source, target, link in layout
+                if not os.path.islink(source) or os.readlink(source) != link]:
+            printMessage('Sysroot layout of ' + prefix + ' is in place')
+            return
+    except (IOError, ValueError):
+        pass
+    actions = sysrootActions(buildConfig)
+    try:
+        for action, path, other in actions:
+            if action == 'move':
+                os.rename(path, other)
+            elif action == 'remove' and os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif action == 'remove':
+                os.remove(path)
+            elif action == 'rmdir':
+                os.rmdir(path)
+            elif action == 'link':
+                if not os.path.exists(os.path.dirname(other)):
+                    os.makedirs(os.path.dirname(other))
+                os.symlink(path, other)
+        tmp = manifest + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump([[source, link] for source, target, link in layout], f)
+        finally:
+            f.close()
+        os.rename(tmp, manifest)
+    except (IOError, OSError), exc:
+        printMessage('Error when finalizing the sysroot of ' + prefix + ' : ' + str(exc))
         sys.exit(1)
-    tar_binutils, src_binutils = getSourceTarball('binutils', buildConfig.binutils, downloads, build)
-    decompress(tar_binutils, build, src_binutils)
-    tar_gcc, src_gcc = getSourceTarball('gcc',   buildConfig.gcc, downloads, build)
-    decompress(tar_gcc, build, src_gcc)
+    printMessage('Sysroot layout of ' + prefix + ' : ' + str(len(actions)) + ' renames and links')
 
-    tar_glibc, src_glibc = getSourceTarball('glibc', buildConfig.glibc, downloads, build)
-    decompress(tar_glibc, build, src_glibc)
-    # Merge glibc 'ports' directory for glibc-2.3.5 ~ glibc-2.16.0
-    mergeGlibcPorts(src_glibc, buildConfig.glibc, downloads, build)
+# Multi-threaded compressors of the toolchain packages, by format. A format
+# lists the programs to try in order, '%d' is replaced by the jobs.
+packageCompressor = {
+    'zst' : [('zstd', 'zstd -T%d -10')],
+    'xz'  : [('pixz', 'pixz -p%d'), ('xz', 'xz -T%d -6')],
+    'gz'  : [('pigz', 'pigz -p%d'), ('gzip', 'gzip')],
+}
+
+# Return the compressor command of a package format, '' if none installed.
+def compressProgram(fmt, jobs):
+    for program, command in packageCompressor.get(fmt, []):
+        if findProgram(program) != '':
+            if '%d' in command:
+                command = command % max(1, jobs)
+            return command
+    return ''
 
-    tar_linux, src_linux = getSourceTarball('linux', buildConfig.linux, downloads, build)
-    decompress(tar_linux, build, src_linux)
+def defaultPackageFormat():
+    if findProgram('zstd') != '':
+        return 'zst'
+    return 'xz'
 
-    buildConfig.build = os.path.abspath(build)
-    buildConfig.src_binutils = os.path.abspath(src_binutils)
-    buildConfig.src_gcc      = os.path.abspath(src_gcc)
-    buildConfig.src_glibc    = os.path.abspath(src_glibc)
-    buildConfig.src_linux    = os.path.abspath(src_linux)
+# Name of the package of a toolchain, with the versions of all its
+# components so the toolchains of a matrix don't share an archive.
+def packageName(buildConfig, fmt):
+    return (buildConfig.triple + '-binutils-' + buildConfig.binutils + '-gcc-' +
+            buildConfig.gcc + '-glibc-' + buildConfig.glibc + '-linux-' +
+            buildConfig.linux + '.tar.' + fmt)
 
-# Read value from configuration file, if the key does not exist, return an 
-# empty string.
-def readOptions(config, section, name):
+# Return the machine (e_machine) of an ELF file, None if it is not one.
+def elfMachine(path):
     try:
-        return config.get(section, name)
-    except:
-        return ''
+        f = open(path, 'rb')
+        try:
+            header = f.read(20)
+        finally:
+            f.close()
+    except IOError:
+        return None
+    if len(header) < 20 or header[:4] != '\x7fELF':
+        return None
+    if header[5] == '\x02':
+        return ord(header[18]) << 8 | ord(header[19])
+    return ord(header[19]) << 8 | ord(header[18])
 
-# Read configuration from a ini format file.
-def readConfigFile(buildConfig, cmdopt):
-    configFilePath = cmdopt.config
-    config = ConfigParser.ConfigParser()
-    files = config.read(configFilePath)
-    if not files:
-        print("Could not read configuration file correcttly!")
-        sys.exit(1)
-    section = 'default'
-    buildConfig.binutils = readOptions(config, section, 'binutils')
-    buildConfig.gcc      = readOptions(config, section, 'gcc')
-    buildConfig.glibc    = readOptions(config, section, 'glibc')
-    buildConfig.linux    = readOptions(config, section, 'linux')
-    buildConfig.workdir  = readOptions(config, section, 'workdir')
-    buildConfig.prefix   = readOptions(config, section, 'prefix')
+# The headers of an ELF file needed to check a program: class, byte order,
+# type, machine, dynamic loader and the libraries it needs. Raise ValueError
+# if the file is not an ELF file.
+class ElfFile:
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            self.read(f)
+        finally:
+            f.close()
 
-    if cmdopt.sysroot == '':
-        sysroot  = readOptions(config, section, 'sysroot')
-        if sysroot == 'no' or sysroot == 'off':
-            cmdopt.sysroot == False
+    def read(self, f):
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != '\x7fELF':
+            raise ValueError('not an ELF file')
+        self.elfClass = ord(ident[4]) == 2 and 64 or 32
+        self.byteOrder = ord(ident[5]) == 2 and 'big' or 'little'
+        order = self.byteOrder == 'big' and '>' or '<'
+        if self.elfClass == 64:
+            header, segment, word = 'HHIQQQIHHHHHH', 'IIQQQQQQ', 'q'
         else:
-            cmdopt.sysroot == True
+            header, segment, word = 'HHIIIIIHHHHHH', 'IIIIIIII', 'i'
+        fields = self.unpack(f, order + header)
+        self.type, self.machine = fields[0], fields[1]
+        phoff, phentsize, phnum = fields[4], fields[8], fields[9]
+        loads = []
+        dynamic = None
+        self.interpreter = ''
+        for i in range(phnum):
+            f.seek(phoff + i * phentsize)
+            fields = self.unpack(f, order + segment)
+            if self.elfClass == 64:
+                ptype, offset, vaddr, filesz = fields[0], fields[2], fields[3], fields[5]
+            else:
+                ptype, offset, vaddr, filesz = fields[0], fields[1], fields[2], fields[4]
+            if ptype == 1:
+                loads.append((vaddr, offset, filesz))
+            elif ptype == 2:
+                dynamic = (offset, filesz)
+            elif ptype == 3:
+                f.seek(offset)
+                self.interpreter = f.read(filesz).rstrip('\0')
+        self.dynamic = dynamic is not None
+        self.needed = []
+        if dynamic is None:
+            return
+        # DT_NEEDED entries are offsets in the string table, DT_STRTAB is its
+        # address, mapped to the file through the loadable segments.
+        entry = struct.calcsize(order + word * 2)
+        needed = []
+        strtab = None
+        f.seek(dynamic[0])
+        for i in range(dynamic[1] // entry):
+            tag, value = struct.unpack(order + word * 2, f.read(entry))
+            if tag == 0:
+                break
+            elif tag == 1:
+                needed.append(value)
+            elif tag == 5:
+                strtab = value
+        if strtab is None:
+            return
+        for vaddr, offset, filesz in loads:
+            if vaddr <= strtab < vaddr + filesz:
+                strtab = strtab - vaddr + offset
+                break
+        for value in needed:
+            f.seek(strtab + value)
+            self.needed.append(f.read(256).split('\0')[0])
 
-    if cmdopt.builtin == '':
-        buildConfig.target   = readOptions(config, section, 'target')
-        buildConfig.triple   = readOptions(config, section, 'triple')
-        buildConfig.fpu      = readOptions(config, section, 'fpu')
-        buildConfig.floatabi = readOptions(config, section, 'floatabi')
-        buildConfig.abi      = readOptions(config, section, 'abi')
-        buildConfig.cpu      = readOptions(config, section, 'cpu')
-        buildConfig.arch     = readOptions(config, section, 'arch')
+    def unpack(self, f, fmt):
+        data = f.read(struct.calcsize(fmt))
+        if len(data) < struct.calcsize(fmt):
+            raise ValueError('truncated ELF file')
+        return struct.unpack(fmt, data)
 
+# Strip the ELF files of a tree: the host programs lose their symbol tables,
+# the target libraries and objects only their debug information, with the
+# binutils just built. 'files' are stripped by batches with 'jobs' workers.
+def stripTree(buildConfig, root, jobs):
+    hostMachine = elfMachine(os.path.realpath('/bin/sh'))
+    targetStrip = buildConfig.prefix + '/bin/' + buildConfig.triple + '-strip'
+    host   = []
+    target = []
+    for path, dirs, files in os.walk(root):
+        for name in files:
+            filename = path + '/' + name
+            if os.path.islink(filename):
+                continue
+            machine = elfMachine(filename)
+            if machine is None:
+                continue
+            if machine == hostMachine:
+                host.append(filename)
+            else:
+                target.append(filename)
+    batches = []
+    for i in range(0, len(host), 64):
+        batches.append(['strip', '--strip-unneeded'] + host[i:i + 64])
+    if os.path.exists(targetStrip):
+        for i in range(0, len(target), 64):
+            batches.append([targetStrip, '--strip-debug'] + target[i:i + 64])
 
-# If *_INCLUDE_PATH was set, something went wrong. So unset them.
-def setEnv():
-    os.unsetenv('C_INCLUDE_PATH')
-    os.unsetenv('CPLUS_INCLUDE_PATH')
+    # A file strip doesn't understand is left as it is. The workers have no
+    # stage of their own, they run the commands for the calling one.
+    stage = currentStage('package')
+    def strip(args):
+        if runCommand(args, stage, 'strip', check=False) != 0:
+            printMessage('Warning : ' + os.path.basename(args[0]) + ' left some files of ' +
+                         root + ' as they are')
+    runWorkers(strip, batches, jobs)
+    printMessage('Strip ' + str(len(host)) + ' host and ' + str(len(target)) +
+                 ' target files')
 
-# Prepend ${PREFIX}/bin to PATH for building glibc.
-def setEnvPath(buildConfig):
-    oldPath = os.environ['PATH']
-    prefix  = buildConfig.prefix
-    newBin  = os.path.abspath(prefix + '/bin')
-    newPath = newBin + ':' + oldPath
-    os.environ['PATH'] = newPath
+# ELF machine, byte order, class and dynamic loader of the programs of the
+# target architectures, by the first part of the triple.
+elfTargets = {
+    'aarch64'    : (183, 'little', 64, '/lib/ld-linux-aarch64.so.1'),
+    'aarch64_be' : (183, 'big',    64, '/lib/ld-linux-aarch64_be.so.1'),
+    'x86_64'     : (62,  'little', 64, '/lib64/ld-linux-x86-64.so.2'),
+}
 
-def printHelpMessage():
-    helpMsg = """Usage: toolchainbot [OPTIONS] ...
-build a cross toolchain automaticly.
+verifyHello = '''#include <stdio.h>
+int main(void) { printf("hello\\n"); return 0; }
+'''
 
-    -h, --help              Print this help message
-    -l, --list              List all supported builtin toolchain
-        --config=filename   Use configuration file
-        --prefix=path       Set installation path
-        --builtin=name      Build a builtin toolchain, must specify installation
-                            path use --prefix option
-        --jobs=number       Specifies the number of jobs to run simultaneously.
-"""
-    print(helpMsg)
-    sys.exit(0)
+verifyThreads = '''#include <pthread.h>
+static void *run(void *arg) { return arg; }
+int main(void) {
+    pthread_t thread;
+    void *result;
+    if (pthread_create(&thread, 0, run, &thread) != 0) return 1;
+    pthread_join(thread, &result);
+    return result != &thread;
+}
+'''
+
+verifyCxx = '''#include <iostream>
+#include <string>
+#include <vector>
+int main() {
+    std::vector<std::string> words;
+    words.push_back("hello");
+    try { throw words.size(); } catch (size_t n) { std::cout << words[0] << n << std::endl; }
+    return 0;
+}
+'''
+
+# The programs built with the new toolchain: name, language, options,
+# source, and the libraries a dynamic program needs (None if static).
+verifyPrograms = [
+    ('hello',      'c',   [],           verifyHello,   ['libc.so.6']),
+    ('static',     'c',   ['-static'],  verifyHello,   None),
+    ('threads',    'c',   ['-pthread'], verifyThreads, ['libc.so.6']),
+    ('cxx',        'c++', [],           verifyCxx,     ['libstdc++.so.6', 'libc.so.6']),
+    ('cxx-static', 'c++', ['-static'],  verifyCxx,     None),
+]
+
+# True if 'path' exists in the sysroot 'root', the symbolic links are
+# followed inside it.
+def sysrootExists(root, path):
+    for i in range(16):
+        name = root + path
+        if not os.path.islink(name):
+            return os.path.exists(name)
+        target = os.readlink(name)
+        if target.startswith('/'):
+            path = target
+        else:
+            path = os.path.normpath(os.path.dirname(path) + '/' + target)
+    return False
+
+def verifyCommand(buildConfig, program, directory):
+    name, language, options, source, needed = program
+    compiler = language == 'c' and 'gcc' or 'g++'
+    extension = language == 'c' and '.c' or '.cc'
+    return ([buildConfig.prefix + '/bin/' + buildConfig.triple + '-' + compiler, '-O2',
+             '-o', directory + '/' + name, directory + '/' + name + extension] + options)
+
+# Check a program built by the toolchain, return its problems.
+def verifyProgram(buildConfig, program, path):
+    name, language, options, source, needed = program
+    try:
+        elf = ElfFile(path)
+    except (IOError, ValueError, struct.error), exc:
+        return [name + ' : ' + str(exc)]
+    problems = []
+    arch = buildConfig.triple.split('-')[0]
+    if arch in elfTargets:
+        machine, byteOrder, elfClass, interpreter = elfTargets[arch]
+        if elf.machine != machine:
+            problems.append(name + ' : machine ' + str(elf.machine) + ', not ' + str(machine))
+        if elf.byteOrder != byteOrder:
+            problems.append(name + ' : ' + elf.byteOrder + ' endian, not ' + byteOrder)
+        if elf.elfClass != elfClass:
+            problems.append(name + ' : ELF' + str(elf.elfClass) + ', not ELF' + str(elfClass))
+        if needed is not None and elf.interpreter != interpreter:
+            problems.append(name + ' : dynamic loader ' + repr(elf.interpreter) +
+                            ', not ' + interpreter)
+    root = buildConfig.options.libpath
+    if buildConfig.options.sysroot != '':
+        root = buildConfig.sysroot
+    if needed is None:
+        if elf.interpreter != '' or elf.needed:
+            problems.append(name + ' : not static, needs ' + ' '.join(elf.needed))
+        return problems
+    if elf.interpreter != '' and not sysrootExists(root, elf.interpreter):
+        problems.append(name + ' : dynamic loader ' + elf.interpreter + ' missing in ' + root)
+    for library in needed:
+        if library not in elf.needed:
+            problems.append(name + ' : does not need ' + library)
+    # The target libraries of gcc are installed in ${PREFIX}/${TARGET}, the
+    # ones of glibc in the sysroot.
+    roots = [root, buildConfig.prefix + '/' + buildConfig.triple]
+    dirs = ['/lib', '/lib64', '/usr/lib', '/usr/lib64',
+            '/lib/' + buildConfig.triple, '/usr/lib/' + buildConfig.triple]
+    for library in elf.needed:
+        if not [d for r in roots for d in dirs if sysrootExists(r, d + '/' + library)]:
+            problems.append(name + ' : ' + library + ' missing in ' + root)
+    return problems
+
+# Build the test programs with the new toolchain, by 'jobs' workers, and
+# check the machine, byte order, dynamic loader and libraries of the
+# results. Exit if any of them fails.
+def verifyToolchain(buildConfig, jobs):
+    directory = buildConfig.build + '/verify'
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    problems = []
+    stage = currentStage('verify')
+
+    def verify(program):
+        name, language, options, source, needed = program
+        f = open(directory + '/' + name + (language == 'c' and '.c' or '.cc'), 'w')
+        try:
+            f.write(source)
+        finally:
+            f.close()
+        try:
+            runCommand(verifyCommand(buildConfig, program, directory), stage, 'build ' + name,
+                       env=toolEnv(buildConfig))
+        except OSError, exc:
+            problems.append(name + ' : build failed : ' + str(exc))
+            return
+        problems.extend(verifyProgram(buildConfig, program, directory + '/' + name))
+
+    # The programs whose build failed.
+    for program in runWorkers(verify, verifyPrograms, jobs):
+        problems.append(program[0] + ' : build failed')
+    for problem in problems:
+        printMessage('Verify ' + problem)
+    if problems:
+        sys.exit(1)
+    printMessage('Verify ' + buildConfig.triple + ' : ' + str(len(verifyPrograms)) +
+                 ' programs OK')
+
+# Make the absolute symbolic links pointing inside the tree relative, so the
+# tree still works once moved.
+def relocateLinks(root, prefix):
+    for path, dirs, files in os.walk(root):
+        for name in dirs + files:
+            filename = path + '/' + name
+            if not os.path.islink(filename):
+                continue
+            target = os.readlink(filename)
+            if target == prefix or target.startswith(prefix + '/'):
+                target = root + target[len(prefix):]
+                os.remove(filename)
+                os.symlink(os.path.relpath(target, path), filename)
+
+# Return the sha256 of every regular file of a tree, by path relative to
+# the root. The files are hashed with 'jobs' workers, hashlib releases the
+# interpreter lock.
+def hashTree(root, jobs):
+    files = []
+    for path, dirs, names in os.walk(root):
+        for name in names:
+            filename = path + '/' + name
+            if not os.path.islink(filename) and os.path.isfile(filename):
+                files.append(filename)
+    digests = {}
+
+    def hashFile(filename):
+        h = hashlib.sha256()
+        f = open(filename, 'rb')
+        try:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+        digests[os.path.relpath(filename, root)] = h.hexdigest()
+    if runWorkers(hashFile, files, jobs):
+        printMessage('Error when hashing ' + root)
+        sys.exit(1)
+    return digests
+
+# Replace the files of a tree having the same content and mode by hard links
+# to one of them, return the bytes saved.
+def dedupTree(root, digests):
+    first = {}
+    saved = 0
+    for name in sorted(digests.keys()):
+        filename = root + '/' + name
+        st = os.lstat(filename)
+        key = (digests[name], st.st_mode)
+        if key not in first:
+            first[key] = (filename, st)
+            continue
+        original, ost = first[key]
+        if (ost.st_dev, ost.st_ino) == (st.st_dev, st.st_ino):
+            continue
+        os.link(original, filename + '.dedup')
+        os.rename(filename + '.dedup', filename)
+        saved = saved + st.st_size
+    return saved
+
+manifestName = 'MANIFEST.sha256'
+
+# The manifest of a package uses the format of sha256sum.
+def writeManifest(root, digests):
+    f = open(root + '/' + manifestName, 'w')
+    try:
+        for name in sorted(digests.keys()):
+            f.write(digests[name] + '  ./' + name + '\n')
+    finally:
+        f.close()
+
+def readManifest(root):
+    digests = {}
+    f = open(root + '/' + manifestName)
+    try:
+        for line in f:
+            digest, name = line.rstrip('\n').split('  ', 1)
+            digests[os.path.normpath(name)] = digest
+    finally:
+        f.close()
+    return digests
+
+# Package the installed toolchain in 'dest': a stripped copy of the prefix,
+# with identical files hard linked and a manifest of the file hashes, is
+# archived with paths relative to the prefix so it can be deployed anywhere.
+def packageToolchain(buildConfig, dest, fmt, jobs):
+    stage = 'package'
+    staging = buildConfig.build + '/package'
+    if os.path.exists(staging):
+        shutil.rmtree(staging)
+    runCommand(['cp', '-a', buildConfig.prefix, staging], stage, 'copy')
+    relocateLinks(staging, buildConfig.prefix)
+    stripTree(buildConfig, staging, jobs)
+    digests = hashTree(staging, jobs)
+    saved = dedupTree(staging, digests)
+    printMessage('Deduplicate ' + staging + ' : %.1fM saved' % (saved / 1048576.0))
+    writeManifest(staging, digests)
+    compressor = compressProgram(fmt, jobs)
+    if compressor == '':
+        printMessage('Error! No compressor for the package format ' + fmt)
+        sys.exit(1)
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    archive = os.path.abspath(dest + '/' + packageName(buildConfig, fmt))
+    # tar keeps the hard links, the owner is dropped so the archive only
+    # depends on the content.
+    runCommand(['tar', '-c', '--sort=name', '--owner=0', '--group=0', '--numeric-owner',
+                '--use-compress-program=' + compressor, '-f', archive + '.part',
+                '-C', staging, '.'], stage, 'archive')
+    os.rename(archive + '.part', archive)
+    shutil.rmtree(staging)
+    printMessage('Package ' + archive)
+
+# Unpack a package into 'prefix' with a parallel decompressor and check the
+# files against its manifest.
+def deployToolchain(archive, prefix, jobs):
+    stage = 'deploy'
+    if not os.path.exists(prefix):
+        os.makedirs(prefix)
+    runCommand(['tar', 'x'] + decompressOptions(archive) + ['-f', archive, '-C', prefix],
+               stage, 'extract')
+    expected = readManifest(prefix)
+    actual = hashTree(prefix, jobs)
+    bad = [name for name in sorted(expected.keys()) if actual.get(name) != expected[name]]
+    for name in bad:
+        printMessage('Corrupted file ' + prefix + '/' + name)
+    if bad:
+        sys.exit(1)
+    printMessage('Deploy ' + archive + ' to ' + prefix + ' : ' + str(len(expected)) +
+                 ' files checked')
+
+# A build stage. A stage consumes the products named in 'inputs' and provides
+# the ones named in 'outputs', dependencies between stages are derived from
+# them. Inputs that no stage provides (e.g. source trees) are always ready.
+class Stage:
+    def __init__(self, name, func, inputs, outputs, maxJobs=0, skip=False,
+                 fingerprint=None, root='', excludes=[], plan=None, paths=[], place=''):
+        self.name    = name
+        # Called with the number of make jobs granted to the stage.
+        self.func    = func
+        self.inputs  = inputs
+        self.outputs = outputs
+        # Max number of jobs the stage could make use of, 0 means no limit.
+        self.maxJobs = maxJobs
+        self.skip    = skip
+        # Everything the result of the stage depends on besides its upstream
+        # stages: source digests, configuration, command lines.
+        self.fingerprint = fingerprint
+        # Directory the stage installs files into, and the sub directories
+        # owned by other stages. Only stages with a root are cached.
+        self.root     = root
+        self.excludes = excludes
+        # Directories the stage reads besides its root (source trees), sent
+        # to the host running it.
+        self.paths    = paths
+        # Path the stage writes to, part of the resume identity, which the
+        # fingerprint may leave out so the cache is shared between prefixes.
+        self.place    = place
+        self.executor = localExecutor
+        # Memory used by one make job, in bytes, 0 if unknown.
+        self.memPerJob = 0
+        # Called with the number of make jobs, return the commands of the
+        # stage as (step, argv, cwd) for --plan.
+        self.plan    = plan
+        self.deps    = []
+        self.key     = ''
+
+# Global job budget shared by all running stages, so the total make
+# parallelism never exceeds --jobs.
+# With a 'memory' budget in bytes, the jobs granted to a stage are also
+# limited by the memory a job of the stage needs.
+class JobBudget:
+    def __init__(self, total, memory=0):
+        self.total = max(1, total)
+        self.free  = self.total
+        self.memory  = memory
+        self.memFree = memory
+
+    # Grant up to 'want' jobs, return 0 if the budget is exhausted.
+    def grant(self, want, memPerJob=0):
+        n = min(want, self.free)
+        if self.memory != 0 and memPerJob != 0:
+            n = min(n, self.memFree // memPerJob)
+            # A stage too big for the memory still runs, alone.
+            if n <= 0 and self.free == self.total:
+                n = 1
+            n = max(0, n)
+            self.memFree = self.memFree - n * memPerJob
+        self.free = self.free - n
+        return n
+
+    def release(self, n, memPerJob=0):
+        self.free = self.free + n
+        if self.memory != 0 and memPerJob != 0:
+            self.memFree = self.memFree + n * memPerJob
+
+# Bump it when the layout of cache entries or the stage keys change.
+cacheFormat = 1
+
+# Record the type, size and mtime of every file under 'root'.
+def snapshotTree(root, excludes=[]):
+    snapshot = {}
+    if not os.path.isdir(root):
+        return snapshot
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in list(dirnames):
+            path = os.path.join(dirpath, name)
+            if path in excludes:
+                dirnames.remove(name)
+                continue
+            # Symbolic links to directories are recorded as files.
+            if os.path.islink(path):
+                filenames.append(name)
+                dirnames.remove(name)
+                continue
+            snapshot[os.path.relpath(path, root)] = ('d', 0, 0)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            snapshot[os.path.relpath(path, root)] = ('f', st.st_size, st.st_mtime)
+    return snapshot
+
+# Return the files created or modified between two snapshots.
+def changedFiles(before, after):
+    files = []
+    for path, info in after.items():
+        if path not in before:
+            files.append(path)
+        elif info[0] != 'd' and before[path] != info:
+            files.append(path)
+    files.sort()
+    return files
+
+# Local cache of the files installed by build stages, an entry is addressed
+# by the key of the stage which installed the files.
+class StageCache:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+
+    def entry(self, key):
+        return self.path + '/' + key[:2] + '/' + key
+
+    def has(self, key):
+        return os.path.exists(self.entry(key) + '/files.tar')
+
+    def restore(self, key, root):
+        if not os.path.exists(root):
+            os.makedirs(root)
+        runCommand(['tar', 'xf', self.entry(key) + '/files.tar', '-C', root],
+                   'cache ' + key, 'restore')
+
+    def store(self, key, root, files, stage):
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            return
+        # Fill a private directory first, then publish it atomically.
+        tmp = entry + '.' + str(os.getpid()) + '.' + str(threading.current_thread().ident)
+        os.makedirs(tmp)
+        fileList = open(tmp + '/files.list', 'wb')
+        try:
+            fileList.write('\0'.join(files))
+        finally:
+            fileList.close()
+        ret = subprocess.call(['tar', 'cf', tmp + '/files.tar', '-C', root,
+                               '--no-recursion', '--null', '-T', tmp + '/files.list'])
+        if ret != 0:
+            shutil.rmtree(tmp)
+            printMessage('Warning : Could not store ' + stage + ' into cache.')
+            return
+        meta = open(tmp + '/meta.json', 'w')
+        try:
+            json.dump({'stage': stage, 'key': key, 'files': len(files),
+                       'time': time.time()}, meta)
+        finally:
+            meta.close()
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # Another build stored the same entry meanwhile.
+            shutil.rmtree(tmp)
+
+stateName = '.toolchainbot-state.json'
+
+# The stages completed in a workdir, with their keys. A rerun resumes after
+# the stages whose key did not change, see Scheduler.resumable().
+class BuildState:
+    def __init__(self, workdir, readOnly=False):
+        self.path = workdir + '/' + stateName
+        self.readOnly = readOnly
+        self.stages = {}
+        try:
+            f = open(self.path)
+            try:
+                self.stages = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+
+    def completed(self, name, key):
+        return self.stages.get(name) == key
+
+    def record(self, name, key):
+        self.stages[name] = key
+        self.save()
+
+    def forget(self, name):
+        if name in self.stages:
+            del self.stages[name]
+            self.save()
+
+    def save(self):
+        if self.readOnly:
+            return
+        f = open(self.path + '.tmp', 'w')
+        try:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+# Run stages in dependency order, independent stages run concurrently.
+# The process engine, the stage logs and the build report know the stages by
+# name and are global, so one scheduler runs at a time in a process: the
+# toolchains built together share a scheduler and have tagged stage names,
+# the build service runs every build in its own process.
+class Scheduler:
+    running = threading.Lock()
+
+    def __init__(self, stages, jobs, cache=None, memory=0, state=None, keepGoing=False,
+                 workers=[], resume=True):
+        self.stages = stages
+        self.budget = JobBudget(jobs, memory)
+        # The hosts running the stages with their job budgets, this one first.
+        self.hosts  = [(localExecutor, self.budget)]
+        self.hosts.extend([(worker, JobBudget(worker.jobs)) for worker in workers])
+        self.cache  = cache
+        self.state  = state
+        # Without resume every stage runs and the state forgets the ones
+        # run: the sources may carry local changes the keys know nothing
+        # about (incremental mode).
+        self.resume = resume
+        # Go on with the stages which don't depend on a failed one.
+        self.keepGoing = keepGoing
+        self.failed = []
+        self.done   = set()
+        # Stages run by this build, their dependents can't be resumed.
+        self.ran    = set()
+        # Stages restored from the stage cache.
+        self.restored = set()
+        self.resolveDeps()
+        self.computeKeys()
+
+    def resolveDeps(self):
+        providers = {}
+        for stage in self.stages:
+            for item in stage.outputs:
+                providers[item] = stage
+        for stage in self.stages:
+            stage.deps = []
+            for item in stage.inputs:
+                if item in providers and providers[item] is not stage:
+                    if providers[item] not in stage.deps:
+                        stage.deps.append(providers[item])
+
+    # The key of a stage covers its own fingerprint and the keys of its
+    # upstream stages, so a change anywhere upstream changes the key.
+    def computeKeys(self):
+        def computeKey(stage, visiting):
+            if stage.key != '':
+                return stage.key
+            if stage in visiting:
+                print('Error! Cyclic dependency at stage ' + stage.name)
+                sys.exit(1)
+            visiting.append(stage)
+            upstream = [computeKey(dep, visiting) for dep in stage.deps]
+            upstream.sort()
+            # The tag is left out, the same stage of two toolchains has the
+            # same key if it does the same work.
+            material = json.dumps([cacheFormat, stageKind(stage.name), stage.fingerprint,
+                                   upstream], sort_keys=True)
+            stage.key = hashlib.sha256(material).hexdigest()
+            visiting.remove(stage)
+            return stage.key
+        for stage in self.stages:
+            computeKey(stage, [])
+
+    # A stage completed by a previous build is not run again, unless one of
+    # its upstream stages ran: it may have overwritten the stage's files.
+    # Key a completed stage is recorded under in the build state.
+    def resumeKey(self, stage):
+        if stage.place == '':
+            return stage.key
+        return hashlib.sha256(stage.key + '\0' + stage.place).hexdigest()
+
+    def resumable(self, stage):
+        if self.state is None or not self.resume:
+            return False
+        if not self.state.completed(stage.name, self.resumeKey(stage)):
+            return False
+        for path in [stage.root, stage.place]:
+            if path != '' and not os.path.exists(path):
+                return False
+        return not [dep for dep in stage.deps if dep in self.ran]
+
+    # Hand out jobs to ready stages, stages with a small job limit first,
+    # every other stage gets a fair share of the budget among the running
+    # and ready stages, or what is left of it.
+    def launchReady(self, pending, done, running, events):
+        ready = [s for s in pending if all(d in done for d in s.deps)]
+        ready.sort(key=lambda s: s.maxJobs == 0 and sys.maxint or s.maxJobs)
+        i = 0
+        while i < len(ready):
+            stage = ready[i]
+            if stage.skip:
+                pending.remove(stage)
+                done.add(stage)
+                printMessage('Skip ' + stage.name)
+                # Its dependents may be ready now.
+                return self.launchReady(pending, done, running, events)
+            if self.resumable(stage):
+                pending.remove(stage)
+                done.add(stage)
+                printMessage('Skip ' + stage.name + ' : completed by a previous build')
+                return self.launchReady(pending, done, running, events)
+            # Stages doing the same work in different prefixes have the same
+            # key, only the first one runs, the others are restored from the
+            # cache once it is done.
+            if self.cache is not None and stage.root != '':
+                if [s for s in running if s.key == stage.key]:
+                    i = i + 1
+                    continue
+                twins = [s for s in self.failed if s.key == stage.key]
+                if twins:
+                    pending.remove(stage)
+                    self.failed.append(stage)
+                    printMessage('Stage ' + stage.name + ' failed : same as ' + twins[0].name)
+                    return self.launchReady(pending, done, running, events)
+            executor, budget = self.place(stage)
+            if stage.maxJobs != 0:
+                share = stage.maxJobs
+            else:
+                here = [s for s in running if s.executor is executor]
+                limited = [running[s] for s in here if s.maxJobs != 0]
+                count = len(here) - len(limited) + len(ready) - i
+                share = max(1, (budget.total - sum(limited)) // count)
+            jobs = budget.grant(share, stage.memPerJob)
+            if jobs == 0:
+                break
+            pending.remove(stage)
+            running[stage] = jobs
+            stage.executor = executor
+            self.ran.add(stage)
+            if self.state is not None:
+                self.state.forget(stage.name)
+            where = ''
+            if executor is not localExecutor:
+                where = ' on ' + executor.name
+            printMessage('Start ' + stage.name + ' (' + str(jobs) + ' jobs)' + where)
+            thread = threading.Thread(target=self.runStage,
+                                      args=(stage, jobs, events))
+            thread.daemon = True
+            thread.start()
+            i = i + 1
+
+    # The host with the most free jobs. Only the stages installing into a
+    # root can run on other hosts, the files they install are pulled back;
+    # the stages found in the cache are restored here.
+    def place(self, stage):
+        if stage.root == '' or (self.cache is not None and self.cache.has(stage.key)):
+            return self.hosts[0]
+        best = self.hosts[0]
+        for host in self.hosts[1:]:
+            if host[1].free > best[1].free:
+                best = host
+        return best
+
+    # Run the stage function on the host of the stage.
+    def runOn(self, stage, jobs):
+        executor = stage.executor
+        for path in [stage.root] + stage.paths:
+            executor.push(path, stage.excludes)
+        stageContext.executor = executor
+        try:
+            stage.func(jobs)
+        finally:
+            stageContext.executor = localExecutor
+        executor.pull(stage.root, stage.excludes)
+
+    def runCached(self, stage, jobs):
+        if self.cache is None or stage.root == '':
+            self.runOn(stage, jobs)
+            return
+        if self.cache.has(stage.key):
+            printMessage('Restore ' + stage.name + ' from cache ' + stage.key[:12])
+            self.cache.restore(stage.key, stage.root)
+            self.restored.add(stage)
+            return
+        before = snapshotTree(stage.root, stage.excludes)
+        self.runOn(stage, jobs)
+        after = snapshotTree(stage.root, stage.excludes)
+        self.cache.store(stage.key, stage.root, changedFiles(before, after), stage.name)
+
+    def runStage(self, stage, jobs, events):
+        error = None
+        stageContext.name = stage.name
+        stageContext.jobs = jobs
+        try:
+            self.runCached(stage, jobs)
+        except SystemExit, exc:
+            error = 'exit code ' + str(exc.code)
+        except Exception:
+            error = traceback.format_exc()
+        events.put((stage, error))
+
+    # Return True if every stage finished successfully. The first failure
+    # cancels the running stages unless keepGoing, an interrupt all of them.
+    def run(self):
+        if not Scheduler.running.acquire(False):
+            raise RuntimeError('Another scheduler is running in this process')
+        try:
+            return self.runAll()
+        except KeyboardInterrupt:
+            processEngine.cancel(None, 'interrupted')
+            raise
+        finally:
+            processEngine.forget([stage.name for stage in self.stages])
+            Scheduler.running.release()
+
+    def runAll(self):
+        pending = list(self.stages)
+        done    = self.done
+        running = {}
+        events  = Queue.Queue()
+        while pending or running:
+            if not self.failed or self.keepGoing:
+                self.launchReady(pending, done, running, events)
+            if not running:
+                break
+            # A timeout keeps the main thread responsive to Ctrl-C.
+            try:
+                stage, error = events.get(True, 3600)
+            except Queue.Empty:
+                continue
+            budget = dict(self.hosts)[stage.executor]
+            budget.release(running.pop(stage), stage.memPerJob)
+            if error is None:
+                done.add(stage)
+                if self.state is not None and self.resume:
+                    self.state.record(stage.name, self.resumeKey(stage))
+                elif self.state is not None:
+                    self.state.forget(stage.name)
+                printMessage('Finish ' + stage.name)
+            elif processEngine.cancelReason(stage.name) != '':
+                self.failed.append(stage)
+                printMessage('Stage ' + stage.name + ' cancelled : ' +
+                             processEngine.cancelReason(stage.name))
+            else:
+                self.failed.append(stage)
+                printMessage('Stage ' + stage.name + ' failed : ' + error)
+                if not self.keepGoing and running:
+                    processEngine.cancel([s.name for s in running], stage.name + ' failed')
+        return not self.failed and not pending
+
+# The make option giving the jobs of a stage, none when make uses the shared
+# jobserver.
+def makeJobs(buildConfig, jobs):
+    if usesJobserver(buildConfig):
+        return ''
+    return '-j' + str(jobs)
+
+# Memory used by one make job of each kind of stage, in bytes, until it has
+# been measured. cc1plus of gcc pass 2 is the hungriest.
+memoryProfile = {
+    'binutils' : 250 << 20,
+    'gcc1'     : 400 << 20,
+    'glibc'    : 300 << 20,
+    'gcc2'     : 900 << 20,
+}
+
+# The kind of a stage is its name without the target tag.
+def stageKind(name):
+    return name.split(':')[-1]
+
+historyName = '.toolchainbot-history.json'
+
+# Measurements of previous builds, by kind of stage: the peak memory of a
+# make job and the duration of the stage.
+def readHistory(workdir):
+    try:
+        f = open(workdir + '/' + historyName)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+# Only the stages of 'built', which finished and were built from scratch,
+# are recorded: a failed or cancelled stage, one restored from the cache or
+# an incremental make in a reused build directory tell nothing about a build.
+def writeHistory(workdir, records, built):
+    history = readHistory(workdir)
+    steps = {}
+    for record in records:
+        steps.setdefault(record.stage, set()).add(record.step)
+    stages = {}
+    names  = {}
+    for record in records:
+        if record.stage not in built or 'restore' in steps[record.stage]:
+            continue
+        if 'make' in steps[record.stage] and 'configure' not in steps[record.stage]:
+            continue
+        kind = stageKind(record.stage)
+        entry = stages.setdefault(kind, {'maxrss': 0, 'wall': 0.0})
+        entry['wall'] = entry['wall'] + record.wall
+        names.setdefault(kind, set()).add(record.stage)
+        if record.step == 'make':
+            entry['maxrss'] = max(entry['maxrss'], record.maxrss)
+    for kind, entry in stages.items():
+        # The peak of a build may be below the one of the builds before it
+        # (fewer jobs, a lucky schedule): the old peak only decays slowly.
+        old = history.get(kind, {})
+        entry['maxrss'] = max(entry['maxrss'], old.get('maxrss', 0) * 7 // 8)
+        # The time of one stage, the toolchains of a batch build have one
+        # stage of each kind.
+        entry['wall'] = entry['wall'] / len(names[kind])
+        history[kind] = entry
+    f = open(workdir + '/' + historyName, 'w')
+    try:
+        json.dump(history, f, indent=2)
+    finally:
+        f.close()
+
+# Memory used by one make job of a stage, as measured by the previous build
+# or from the default profile. The peak RSS of make's children is the RSS of
+# the biggest compiler process, so it is the memory of one job.
+def stageMemory(history, name):
+    kind = stageKind(name)
+    if kind in history and history[kind].get('maxrss', 0) > 0:
+        return history[kind]['maxrss']
+    return memoryProfile.get(kind, 100 << 20)
+
+# A GNU make jobserver shared by all the make processes of the build, so the
+# number of jobs stays bounded even when the stages don't use all of theirs.
+class MakeJobserver:
+    def __init__(self, jobs):
+        self.read, self.write = os.pipe()
+        # Every make has one implicit token.
+        os.write(self.write, '+' * max(0, jobs - 1))
+        self.jobs = jobs
+        # make 4.2 renamed the option.
+        self.option = '--jobserver-auth'
+        try:
+            proc = subprocess.Popen(['make', '--version'], stdout=subprocess.PIPE)
+            version = re.findall(r'GNU Make (\d+)\.(\d+)', proc.communicate()[0])
+            if version and (int(version[0][0]), int(version[0][1])) < (4, 2):
+                self.option = '--jobserver-fds'
+        except OSError:
+            pass
+
+    def setEnv(self, env):
+        env['MAKEFLAGS'] = (' -j' + str(self.jobs) + ' ' + self.option + '=' +
+                            str(self.read) + ',' + str(self.write))
+
+# Digests of source tarballs, keyed by path, size and mtime.
+digestMemo = {}
+digestLock = threading.Lock()
+
+def fileDigest(path):
+    st = os.stat(path)
+    memoKey = (path, st.st_size, st.st_mtime)
+    digestLock.acquire()
+    try:
+        if memoKey in digestMemo:
+            return digestMemo[memoKey]
+    finally:
+        digestLock.release()
+    sha = hashlib.sha256()
+    f = open(path, 'rb')
+    try:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            sha.update(data)
+    finally:
+        f.close()
+    digestLock.acquire()
+    digestMemo[memoKey] = sha.hexdigest()
+    digestLock.release()
+    return sha.hexdigest()
+
+# Identify a source package by the digest of its tarball, or by its name
+# when only an extracted tree is available.
+def sourceDigest(buildConfig, name, version):
+    fullName = name + '-' + version
+    tarball = findTarball(name, version, buildConfig.workdir + '/downloads')
+    if tarball == '' and buildConfig.sharedCache != '':
+        tarball = findTarball(name, version, buildConfig.sharedCache + '/downloads')
+    if tarball == '':
+        return fullName
+    return fullName + ':' + fileDigest(tarball)
+
+# Configuration which affects the result of every stage.
+def configDigest(buildConfig):
+    return [buildConfig.prefix, buildConfig.sysroot, buildConfig.triple,
+            buildConfig.kernel_header, buildConfig.target, buildConfig.fpu,
+            buildConfig.floatabi, buildConfig.abi, buildConfig.cpu,
+            buildConfig.arch, buildConfig.endian,
+            buildConfig.options.libpath, buildConfig.options.libprefix]
+
+# Stages installing the kernel headers, once for each linux version and
+# architecture used by the toolchains. They keep their own cache of header
+# trees, so the stage cache is not used.
+def buildHeaderStages(buildConfigs, cmdopt):
+    stages = []
+    for buildConfig in buildConfigs:
+        path = kernelHeaderDir(buildConfig)
+        name = 'header-' + buildConfig.kernel_header + '-' + buildConfig.linux
+        if 'headers:' + path in [st.outputs[0] for st in stages]:
+            continue
+
+        def install(jobs, buildConfig=buildConfig, path=path):
+            installKernelHeader(buildConfig, path)
+
+        def plan(jobs, buildConfig=buildConfig, path=path):
+            build = kernelHeaderBuild(buildConfig)
+            return [('make headers check', kernelHeaderCheck(buildConfig), build),
+                    ('install', kernelHeaderInstall(buildConfig, path), build)]
+
+        stage = Stage(name, install, ['src_linux'], ['headers:' + path], maxJobs=1,
+                      skip=skipped(cmdopt, 'header'),
+                      fingerprint={'sources': [sourceDigest(buildConfig, 'linux', buildConfig.linux)],
+                                   'arch': buildConfig.kernel_header},
+                      plan=plan, place=path)
+        stages.append(stage)
+    return stages
+
+def skipped(cmdopt, name):
+    return name in cmdopt.skipList or 'all' in cmdopt.skipList
 
-# Print a list of supported builtin target.
-# Not implemented yet.
+# Describe the toolchain build as a stage graph. The names of stages and
+# products are prefixed by 'tag', so that the graphs of several toolchains
+# can be scheduled together.
+def buildStageGraph(buildConfig, cmdopt, tag=''):
+    # With a sysroot the toolchain is relocatable, the prefix and the workdir
+    # (the sources are known by their digests) are left out of the
+    # fingerprints so that toolchains installed in different prefixes share
+    # their stages through the stage cache.
+    def fingerprint(sources, commands):
+        material = json.dumps({'sources': sources,
+                               'config' : configDigest(buildConfig),
+                               'commands': commands})
+        if buildConfig.options.sysroot != '':
+            material = material.replace(json.dumps(buildConfig.prefix)[1:-1], '@PREFIX@')
+            material = material.replace(json.dumps(buildConfig.workdir)[1:-1], '@WORKDIR@')
+        return json.loads(material)
+
+    binutilsSource = [sourceDigest(buildConfig, 'binutils', buildConfig.binutils)]
+    gccSource      = [sourceDigest(buildConfig, 'gcc', buildConfig.gcc)]
+    glibcSource    = [sourceDigest(buildConfig, 'glibc', buildConfig.glibc)]
+    if needGlibcPorts(buildConfig.glibc):
+        glibcSource.append(sourceDigest(buildConfig, 'glibc-ports', buildConfig.glibc))
+
+    prefix = buildConfig.prefix
+    header = os.path.abspath(buildConfig.options.libpath + '/include')
+    headerDir = kernelHeaderDir(buildConfig)
+
+    def binutils(jobs):
+        buildBinutils(buildConfig, makeJobs(buildConfig, jobs))
+
+    def gcc1(jobs):
+        buildGccPass1(buildConfig, makeJobs(buildConfig, jobs))
+
+    def kernelHeader(jobs):
+        copyKernelHeader(buildConfig, headerDir)
+
+    def glibc(jobs):
+        buildGlibc(buildConfig, makeJobs(buildConfig, jobs))
+
+    def libpath(jobs):
+        finalizeSysroot(buildConfig)
+
+    def gcc2(jobs):
+        buildGccPass2(buildConfig, makeJobs(buildConfig, jobs))
+
+    def verify(jobs):
+        verifyToolchain(buildConfig, jobs)
+
+    def package(jobs):
+        packageToolchain(buildConfig, cmdopt.package, cmdopt.packageFormat, jobs)
+
+    def autotoolsPlan(steps, name):
+        build = buildConfig.build + '/' + name
+        return lambda jobs: [(step, args, build)
+                             for step, args in steps(buildConfig, makeJobs(buildConfig, jobs))]
+
+    def headerPlan(jobs):
+        return [('copy', kernelHeaderCopy(buildConfig, headerDir), '')]
+
+    def libpathPlan(jobs):
+        commands = {'move'  : lambda path, other: ['mv', path, other],
+                    'remove': lambda path, other: ['rm', '-r', path],
+                    'rmdir' : lambda path, other: ['rmdir', path],
+                    'link'  : lambda path, other: ['ln', '-s', path, other]}
+        return [(action, commands[action](path, other), '')
+                for action, path, other in sysrootActions(buildConfig)]
+
+    def verifyPlan(jobs):
+        directory = buildConfig.build + '/verify'
+        return [('build ' + program[0], verifyCommand(buildConfig, program, directory), '')
+                for program in verifyPrograms]
+
+    def packagePlan(jobs):
+        staging = buildConfig.build + '/package'
+        return [('copy', ['cp', '-a', prefix, staging], ''),
+                ('archive', ['tar', '-c', '--use-compress-program=' +
+                             compressProgram(cmdopt.packageFormat, jobs), '-f',
+                             cmdopt.package + '/' + packageName(buildConfig, cmdopt.packageFormat),
+                             '-C', staging, '.'], '')]
+
+    # binutils and gcc pass 1 run along with the kernel header install, so
+    # the header directory is not part of their outputs.
+    stages = [
+        Stage(tag + 'binutils', binutils, ['src_binutils'], [tag + 'binutils'],
+              skip=skipped(cmdopt, 'binutils'),
+              fingerprint=fingerprint(binutilsSource, [binutilsConfigure(buildConfig)]),
+              root=prefix, excludes=[header], paths=[buildConfig.src_binutils],
+              plan=autotoolsPlan(binutilsSteps, 'build-binutils')),
+        Stage(tag + 'gcc1',     gcc1,     ['src_gcc', tag + 'binutils'], [tag + 'gcc1'],
+              skip=skipped(cmdopt, 'gcc1'),
+              fingerprint=fingerprint(gccSource, [gccPass1Configure(buildConfig)]),
+              root=prefix, excludes=[header], paths=[buildConfig.src_gcc],
+              plan=autotoolsPlan(gccPass1Steps, 'build-gcc1')),
+        Stage(tag + 'header',   kernelHeader, ['headers:' + headerDir], [tag + 'header'],
+              maxJobs=1, skip=skipped(cmdopt, 'header'),
+              fingerprint=fingerprint([], [header]), plan=headerPlan, place=header),
+        Stage(tag + 'glibc',    glibc,
+              ['src_glibc', tag + 'binutils', tag + 'gcc1', tag + 'header'],
+              [tag + 'glibc'], skip=skipped(cmdopt, 'glibc'),
+              fingerprint=fingerprint(glibcSource, [glibcConfigure(buildConfig),
+                                                    glibcInstall(buildConfig)]),
+              root=prefix, paths=[buildConfig.src_glibc],
+              plan=autotoolsPlan(glibcSteps, 'build-glibc')),
+        Stage(tag + 'libpath',  libpath,  [tag + 'glibc'], [tag + 'libpath'], maxJobs=1,
+              skip=buildConfig.options.sysroot == '', plan=libpathPlan),
+        Stage(tag + 'gcc2',     gcc2,     ['src_gcc', tag + 'glibc', tag + 'libpath'],
+              [tag + 'gcc2'], skip=skipped(cmdopt, 'gcc2'),
+              fingerprint=fingerprint(gccSource, [gccPass2Configure(buildConfig)]),
+              root=prefix, paths=[buildConfig.src_gcc],
+              plan=autotoolsPlan(gccPass2Steps, 'build-gcc2')),
+        Stage(tag + 'verify',   verify,   [tag + 'gcc2', tag + 'libpath'], [tag + 'verify'],
+              maxJobs=len(verifyPrograms), skip=skipped(cmdopt, 'verify'), plan=verifyPlan),
+        Stage(tag + 'package',  package,  [tag + 'gcc2', tag + 'libpath', tag + 'verify'],
+              [tag + 'package'], skip=cmdopt.package == '', plan=packagePlan,
+              place=os.path.abspath(cmdopt.package + '/' +
+                                    packageName(buildConfig, cmdopt.packageFormat))),
+    ]
+    # A stage completed for another prefix is not completed for this one.
+    for stage in stages:
+        if stage.place == '':
+            stage.place = prefix
+    return stages
+
+# Search PATH for an executable, return an empty string if not found.
+def findProgram(name):
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        program = os.path.join(path, name)
+        if os.path.isfile(program) and os.access(program, os.X_OK):
+            return program
+    return ''
+
+# Multi-threaded decompressors used instead of tar's builtin filters when
+# they are installed.
+parallelDecompressor = {
+    '.bz2' : ('pbzip2', '-j'),
+    '.xz'  : ('pixz',   '-J'),
+    '.gz'  : ('pigz',   '-z'),
+    '.zst' : ('pzstd',  '--zstd'),
+}
+
+# Return the tar options selecting the decompressor of a tarball.
+def decompressOptions(tarball):
+    ext = os.path.splitext(tarball)[1]
+    if ext not in parallelDecompressor:
+        return []
+    program, option = parallelDecompressor[ext]
+    if findProgram(program) != '':
+        return ['--use-compress-program=' + program]
+    return [option]
+
+# Decompress source files tarball. The tarball is fed to tar through a pipe,
+# so that the progress can be reported.
+def decompress(tarball, build, source):
+    if os.path.exists(source):
+        printMessage('Skip ' + source)
+        return
+    name = os.path.basename(tarball)
+    printMessage('Uncompress ' + name)
+    total = max(1, os.path.getsize(tarball))
+    start = time.time()
+    proc = subprocess.Popen(['tar', 'x'] + decompressOptions(tarball) +
+                            ['-f', '-', '-C', build], stdin=subprocess.PIPE)
+    done = 0
+    step = 10
+    try:
+        tar = open(tarball, 'rb')
+        try:
+            while True:
+                data = tar.read(1024 * 1024)
+                if not data:
+                    break
+                proc.stdin.write(data)
+                done = done + len(data)
+                if done * 100 // total >= step and done < total:
+                    printMessage('Uncompress ' + name + ' : ' + str(done * 100 // total) + '%')
+                    step = done * 100 // total // 10 * 10 + 10
+        finally:
+            tar.close()
+    except IOError:
+        # tar exited early, its return code tells what happened.
+        pass
+    try:
+        proc.stdin.close()
+    except IOError:
+        pass
+    ret, usage = waitProcess(proc)
+    buildReport.add(StepRecord('source', 'extract ' + name, time.time() - start, usage))
+    if ret == 0:
+        printMessage('Done ' + name + ' (%.1fs)' % (time.time() - start))
+    else:
+        printMessage('Uncompress error! ' + name)
+        sys.exit(1)
+
+# Call func(item) for every item with a pool of 'jobs' worker threads,
+# return the items for which func exited or raised an exception.
+def runWorkers(func, items, jobs):
+    work = Queue.Queue()
+    for item in items:
+        work.put(item)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                item = work.get(False)
+            except Queue.Empty:
+                return
+            try:
+                func(item)
+            except SystemExit:
+                failed.append(item)
+            except Exception:
+                printMessage(traceback.format_exc())
+                failed.append(item)
+
+    workers = []
+    for i in range(max(1, min(jobs, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        while thread.isAlive():
+            thread.join(1)
+    return failed
+
+# Decompress a list of (tarball, build, source) with a pool of 'jobs'
+# workers, exit if any of them failed.
+def decompressAll(tarballs, jobs):
+    tarballs = [item for item in tarballs if item[0]]
+    if runWorkers(lambda item: decompress(*item), tarballs, jobs):
+        sys.exit(1)
+
+# An exclusive lock on a file, shared by the bot instances of a host.
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+# Tarballs and pristine extracted source trees shared by all the workdirs of
+# a host. A source tree is extracted once under a lock, then copied into the
+# workdirs as a reflink copy or, when the filesystem can't do it, as hard
+# links. Hard linked trees must not be modified in place.
+class SharedSourceCache:
+    def __init__(self, path, downloader=None):
+        self.path = os.path.abspath(path)
+        self.downloader = downloader
+        self.reflink = True
+        for sub in ['downloads', 'sources', 'locks']:
+            if not os.path.exists(self.path + '/' + sub):
+                try:
+                    os.makedirs(self.path + '/' + sub)
+                except OSError:
+                    # Created by another instance meanwhile.
+                    pass
+
+    # Return the tarball of a source package, from the shared downloads, the
+    # downloads of the workdir or a mirror.
+    def tarball(self, name, version, localDownloads):
+        downloads = self.path + '/downloads'
+        for path in [downloads, localDownloads]:
+            tarball = findTarball(name, version, path)
+            if tarball != '':
+                return tarball
+        if self.downloader is not None:
+            tarball = self.downloader.download(name, version, downloads)
+            if tarball != '':
+                return tarball
+        printMessage('Error! Could not find tarball of ' + name + '-' + version)
+        sys.exit(1)
+
+    # Return the shared source tree of a package, extract it if needed. The
+    # glibc tree has its 'ports' directory merged.
+    def source(self, name, version, localDownloads):
+        fullName = name + '-' + version
+        path = self.path + '/sources/' + fullName
+        if os.path.exists(path + '.complete'):
+            return path
+        lock = FileLock(self.path + '/locks/' + fullName + '.lock')
+        lock.acquire()
+        try:
+            if os.path.exists(path + '.complete'):
+                return path
+            tmp = (self.path + '/sources/.tmp-' + fullName + '-' + str(os.getpid()) +
+                   '-' + str(threading.current_thread().ident))
+            os.mkdir(tmp)
+            decompress(self.tarball(name, version, localDownloads), tmp, tmp + '/' + fullName)
+            if name == 'glibc' and needGlibcPorts(version):
+                ports = tmp + '/glibc-ports-' + version
+                decompress(self.tarball('glibc-ports', version, localDownloads), tmp, ports)
+                mergeGlibcPorts(tmp + '/' + fullName, ports)
+            # Left over by an instance killed while extracting.
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(tmp + '/' + fullName, path)
+            shutil.rmtree(tmp)
+            open(path + '.complete', 'w').close()
+        finally:
+            lock.release()
+        return path
+
+    # Copy a shared source tree into a workdir.
+    def link(self, source, target):
+        tmp = target + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        ret = 1
+        if self.reflink:
+            devnull = open(os.devnull, 'w')
+            try:
+                ret = subprocess.call(['cp', '-a', '--reflink=always', source, tmp],
+                                      stderr=devnull)
+            finally:
+                devnull.close()
+            if ret != 0:
+                self.reflink = False
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+        if ret != 0:
+            runCommand(['cp', '-al', source, tmp], 'source', 'link ' + os.path.basename(target))
+        os.rename(tmp, target)
+        printMessage('Linked ' + os.path.basename(target) + ' from shared cache')
+
+    # Provide the source trees of all the toolchains in their workdirs,
+    # 'jobs' packages at a time.
+    def populate(self, buildConfigs, jobs):
+        items = []
+        for buildConfig in buildConfigs:
+            for name, version in sourcePackages(buildConfig):
+                if name == 'glibc-ports':
+                    continue
+                target = buildConfig.workdir + '/build/' + name + '-' + version
+                item = (name, version, target, buildConfig.workdir + '/downloads')
+                if not os.path.exists(target) and item not in items:
+                    items.append(item)
+
+        def provide(item):
+            name, version, target, localDownloads = item
+            self.link(self.source(name, version, localDownloads), target)
+
+        if runWorkers(provide, items, jobs):
+            sys.exit(1)
+
+# Mirrors tried after the ones given by --mirror or the configuration file.
+defaultMirrors = [
+    'https://ftp.gnu.org',
+    'https://cdn.kernel.org/pub',
+    'https://mirrors.kernel.org',
+]
+
+# Path of a source tarball inside a mirror.
+def mirrorPath(name, version, fileName):
+    if name == 'gcc':
+        return 'gnu/gcc/gcc-' + version + '/' + fileName
+    if name == 'glibc-ports':
+        return 'gnu/glibc/' + fileName
+    if name == 'linux':
+        major = version.split('.')[0]
+        if major == '2':
+            return 'linux/kernel/v' + '.'.join(version.split('.')[:2]) + '/' + fileName
+        return 'linux/kernel/v' + major + '.x/' + fileName
+    return 'gnu/' + name + '/' + fileName
+
+# Reusable HTTP(S) connections, keyed by scheme and host.
+class ConnectionPool:
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host):
+        self.lock.acquire()
+        try:
+            conns = self.idle.get((scheme, host), [])
+            if conns:
+                return conns.pop()
+        finally:
+            self.lock.release()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=60)
+        return httplib.HTTPConnection(host, timeout=60)
+
+    def put(self, scheme, host, conn):
+        self.lock.acquire()
+        self.idle.setdefault((scheme, host), []).append(conn)
+        self.lock.release()
+
+class DownloadError(Exception):
+    pass
+
+# Download source tarballs from a list of mirrors. Partial downloads are kept
+# in a '.part' file and resumed, tarballs are verified against the known
+# sha256 checksums, from the configuration file or from a '.sha256' file
+# next to the tarball on the mirror.
+class Downloader:
+    def __init__(self, mirrors, checksums={}):
+        self.mirrors   = [m.rstrip('/') for m in mirrors]
+        self.checksums = checksums
+        self.pool      = ConnectionPool()
+
+    # Open 'url' with a request of the bytes from 'offset', return the
+    # response, the status and the connection to give back to the pool.
+    def openHttp(self, url, offset):
+        for redirect in range(5):
+            parts = urlparse.urlsplit(url)
+            path = parts.path
+            if parts.query:
+                path = path + '?' + parts.query
+            headers = {'User-Agent': 'toolchainbot'}
+            if offset > 0:
+                headers['Range'] = 'bytes=' + str(offset) + '-'
+            conn = self.pool.get(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                # An idle connection may have been closed by the server.
+                conn.close()
+                conn = self.pool.get(parts.scheme, parts.netloc)
+                conn.request('GET', path, headers=headers)
+                resp = conn.getresponse()
+            if resp.status in [301, 302, 303, 307, 308]:
+                location = resp.getheader('location')
+                resp.read()
+                self.pool.put(parts.scheme, parts.netloc, conn)
+                url = urlparse.urljoin(url, location)
+                continue
+            return resp, resp.status, (parts.scheme, parts.netloc, conn)
+        raise DownloadError('too many redirects')
+
+    # Fetch 'url' into 'path', resuming a previous partial download.
+    def fetchUrl(self, url, path):
+        offset = 0
+        if os.path.exists(path):
+            offset = os.path.getsize(path)
+        if url.startswith('file://'):
+            source = urllib.url2pathname(urlparse.urlsplit(url).path)
+            if not os.path.exists(source):
+                raise DownloadError('not found')
+            resp = open(source, 'rb')
+            resp.seek(offset)
+            status, conn = offset and 206 or 200, None
+        else:
+            resp, status, conn = self.openHttp(url, offset)
+            if status == 404 or status == 410:
+                resp.read()
+                self.pool.put(*conn)
+                raise DownloadError('not found')
+            if status == 416:
+                # The partial download is already complete.
+                resp.read()
+                self.pool.put(*conn)
+                return
+            if status != 200 and status != 206:
+                conn[2].close()
+                raise DownloadError('HTTP status ' + str(status))
+        try:
+            if status == 200:
+                out = open(path, 'wb')
+            else:
+                out = open(path, 'ab')
+            try:
+                while True:
+                    data = resp.read(1024 * 1024)
+                    if not data:
+                        break
+                    out.write(data)
+            finally:
+                out.close()
+        finally:
+            if conn is None:
+                resp.close()
+            else:
+                self.pool.put(*conn)
+
+    # Return the sha256 checksum expected for 'fileName', an empty string if
+    # it is not known.
+    def expectedChecksum(self, mirrorUrl, fileName, downloads):
+        if fileName in self.checksums:
+            return self.checksums[fileName].split(':')[-1].strip().lower()
+        sidecar = downloads + '/' + fileName + '.sha256'
+        try:
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+            self.fetchUrl(mirrorUrl + '.sha256', sidecar)
+            f = open(sidecar)
+            try:
+                return f.read().split()[0].lower()
+            finally:
+                f.close()
+        except (DownloadError, IOError, IndexError, httplib.HTTPException, socket.error):
+            return ''
+
+    # Download the tarball of a source package into 'downloads', try every
+    # mirror and compression format. Return the tarball path, an empty string
+    # if no mirror has it.
+    def download(self, name, version, downloads):
+        for mirror in self.mirrors:
+            try:
+                tarball = self.downloadFrom(mirror, name, version, downloads)
+                if tarball != '':
+                    return tarball
+            except (httplib.HTTPException, socket.error), exc:
+                # Don't bother an unreachable mirror any more.
+                printMessage('Mirror ' + mirror + ' failed : ' + str(exc))
+        return ''
+
+    def downloadFrom(self, mirror, name, version, downloads):
+        fullName = name + '-' + version
+        for ext in ['.tar.bz2', '.tar.xz', '.tar.gz']:
+            fileName = fullName + ext
+            target = downloads + '/' + fileName
+            part = target + '.part'
+            # Mirrors may use the usual layout or keep all tarballs flat.
+            for url in [mirror + '/' + mirrorPath(name, version, fileName),
+                        mirror + '/' + fileName]:
+                start = time.time()
+                try:
+                    self.fetchUrl(url, part)
+                except DownloadError, exc:
+                    if str(exc) != 'not found':
+                        printMessage('Download ' + url + ' failed : ' + str(exc))
+                    continue
+                except (httplib.HTTPException, socket.error):
+                    raise
+                except IOError, exc:
+                    printMessage('Download ' + url + ' failed : ' + str(exc))
+                    continue
+                checksum = self.expectedChecksum(url, fileName, downloads)
+                if checksum == '':
+                    printMessage('Warning : No checksum to verify ' + fileName)
+                elif fileDigest(part) != checksum:
+                    printMessage('Checksum mismatch : ' + url)
+                    os.remove(part)
+                    continue
+                os.rename(part, target)
+                printMessage('Downloaded ' + fileName + ' (%.1fM in %.1fs)' %
+                             (os.path.getsize(target) / 1048576.0, time.time() - start))
+                return target
+        return ''
+
+    # Download a list of (name, version) concurrently, exit if any of them
+    # could not be found.
+    def downloadAll(self, packages, downloads):
+        failed = []
+        threads = []
+
+        def fetch(name, version):
+            if self.download(name, version, downloads) == '':
+                failed.append(name + '-' + version)
+
+        for name, version in packages:
+            thread = threading.Thread(target=fetch, args=(name, version))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.isAlive():
+                thread.join(1)
+        if failed:
+            print('Error! Could not download :' + ', '.join(failed))
+            sys.exit(1)
+
+# Look for the tarball of a source package in the download directory,
+# return an empty string if there is none.
+def findTarball(name, version, downloads):
+    fullName = name + '-' + version
+    for ext in ['.tar.bz2', '.tar.xz', '.tar.gz']:
+        path = downloads + '/' + fullName + ext
+        if os.path.exists(path):
+            return path
+    return ''
+
+# Prepare source files tarball, download them if needed.
+def getSourceTarball(name, version, downloads, build, downloader=None):
+    fullName = name + '-' + version
+    source = build + '/' + fullName
+    if os.path.exists(source):
+        return False, source
+    path = findTarball(name, version, downloads)
+    if path != '':
+        return path, source
+    tarball = ''
+    if downloader is not None:
+        tarball = downloader.download(name, version, downloads)
+    if not os.path.exists(tarball):
+        print('Error! Could not find :' + tarball)
+        print('name = ' + name + '; version = ' + version)
+        sys.exit(1)
+    return tarball, source
+
+# The glibc 'ports' directory is needed by glibc-2.3.5 ~ glibc-2.16.0
+def needGlibcPorts(glibcVersion):
+    return parseVersion('2.3.5') <= parseVersion(glibcVersion) <= parseVersion('2.16.0')
+
+# Merge glibc-ports directory.
+def mergeGlibcPorts(src_glibc, src_ports):
+    if os.path.exists(src_ports):
+        shutil.move(src_ports, src_glibc)
+
+# Source packages of a toolchain, as (name, version).
+def sourcePackages(buildConfig):
+    packages = [('binutils', buildConfig.binutils),
+                ('gcc', buildConfig.gcc),
+                ('glibc', buildConfig.glibc),
+                ('linux', buildConfig.linux)]
+    if needGlibcPorts(buildConfig.glibc):
+        packages.append(('glibc-ports', buildConfig.glibc))
+    return packages
+
+# Locate the source files directories of linux/binutils/gcc/glibc, return
+# the tarballs to decompress and the glibc 'ports' directory to merge.
+def prepareSource(buildConfig, downloader=None):
+    downloads = buildConfig.workdir + '/' + 'downloads'
+    build     = buildConfig.workdir + '/' + 'build'
+    try:
+        if not os.path.exists(downloads):
+            os.mkdir(downloads)
+        if not os.path.exists(build):
+            os.mkdir(build)
+    except:
+        print('Error when creating directory!')
+        sys.exit(1)
+    tar_binutils, src_binutils = getSourceTarball('binutils', buildConfig.binutils,
+                                                  downloads, build, downloader)
+    tar_gcc, src_gcc = getSourceTarball('gcc',   buildConfig.gcc, downloads, build, downloader)
+    tar_glibc, src_glibc = getSourceTarball('glibc', buildConfig.glibc, downloads, build,
+                                            downloader)
+    tar_linux, src_linux = getSourceTarball('linux', buildConfig.linux, downloads, build,
+                                            downloader)
+    tarballs = [(tar_binutils, build, src_binutils),
+                (tar_gcc, build, src_gcc),
+                (tar_glibc, build, src_glibc),
+                (tar_linux, build, src_linux)]
+    # Merge glibc 'ports' directory for glibc-2.3.5 ~ glibc-2.16.0
+    ports = None
+    if tar_glibc and needGlibcPorts(buildConfig.glibc):
+        tar_ports, src_ports = getSourceTarball('glibc-ports', buildConfig.glibc,
+                                                downloads, build, downloader)
+        tarballs.append((tar_ports, build, src_ports))
+        ports = (src_glibc, src_ports)
+
+    setSourcePaths(buildConfig)
+    return tarballs, ports
+
+# Set the build directory and the source directories of a toolchain.
+def setSourcePaths(buildConfig):
+    build = os.path.abspath(buildConfig.workdir + '/build')
+    buildConfig.build = build
+    buildConfig.src_binutils = build + '/binutils-' + buildConfig.binutils
+    buildConfig.src_gcc      = build + '/gcc-' + buildConfig.gcc
+    buildConfig.src_glibc    = build + '/glibc-' + buildConfig.glibc
+    buildConfig.src_linux    = build + '/linux-' + buildConfig.linux
+
+# Prepare source files directories of all the toolchains, from the shared
+# source cache if there is one. Otherwise the missing tarballs are downloaded
+# concurrently first, and every source package is decompressed only once, by
+# a pool of 'jobs' workers.
+def getSource(buildConfigs, jobs=1, downloader=None, shared=None):
+    for buildConfig in buildConfigs:
+        build = buildConfig.workdir + '/build'
+        if not os.path.exists(build):
+            os.mkdir(build)
+    if shared is not None:
+        shared.populate(buildConfigs, jobs)
+    elif downloader is not None:
+        missing = []
+        for buildConfig in buildConfigs:
+            downloads = buildConfig.workdir + '/downloads'
+            if not os.path.exists(downloads):
+                os.mkdir(downloads)
+            for name, version in sourcePackages(buildConfig):
+                source = buildConfig.workdir + '/build/' + name + '-' + version
+                if os.path.exists(source) or findTarball(name, version, downloads) != '':
+                    continue
+                if (name, version) not in missing:
+                    missing.append((name, version))
+        if missing:
+            downloader.downloadAll(missing, buildConfigs[0].workdir + '/downloads')
+    tarballs = []
+    portsList = []
+    for buildConfig in buildConfigs:
+        items, ports = prepareSource(buildConfig, downloader)
+        for item in items:
+            if item[2] not in [t[2] for t in tarballs]:
+                tarballs.append(item)
+        if ports is not None and ports not in portsList:
+            portsList.append(ports)
+    decompressAll(tarballs, jobs)
+    for src_glibc, src_ports in portsList:
+        mergeGlibcPorts(src_glibc, src_ports)
+
+# Read value from configuration file, if the key does not exist, return an 
+# empty string.
+def readOptions(config, section, name):
+    try:
+        return config.get(section, name)
+    except:
+        return ''
+
+# Read configuration from a ini format file.
+def readConfigFile(buildConfig, cmdopt):
+    configFilePath = cmdopt.config
+    config = ConfigParser.ConfigParser()
+    files = config.read(configFilePath)
+    if not files:
+        print("Could not read configuration file correcttly!")
+        sys.exit(1)
+    section = 'default'
+    buildConfig.binutils = readOptions(config, section, 'binutils')
+    buildConfig.gcc      = readOptions(config, section, 'gcc')
+    buildConfig.glibc    = readOptions(config, section, 'glibc')
+    buildConfig.linux    = readOptions(config, section, 'linux')
+    buildConfig.workdir  = readOptions(config, section, 'workdir')
+    buildConfig.prefix   = readOptions(config, section, 'prefix')
+
+    if cmdopt.cacheDir == '':
+        cmdopt.cacheDir = readOptions(config, section, 'cache_dir')
+    if cmdopt.report == '':
+        cmdopt.report = readOptions(config, section, 'report')
+    if cmdopt.sharedCache == '':
+        cmdopt.sharedCache = readOptions(config, section, 'shared_cache')
+    if cmdopt.scratch == '':
+        cmdopt.scratch = readOptions(config, section, 'scratch')
+    if cmdopt.launcher == '':
+        cmdopt.launcher = readOptions(config, section, 'launcher')
+    if cmdopt.launcherDir == '':
+        cmdopt.launcherDir = readOptions(config, section, 'launcher_dir')
+    if readOptions(config, section, 'incremental') in ['yes', 'on']:
+        cmdopt.incremental = True
+    if cmdopt.logDir == '':
+        cmdopt.logDir = readOptions(config, section, 'log_dir')
+    if cmdopt.package == '':
+        cmdopt.package = readOptions(config, section, 'package')
+    if readOptions(config, section, 'jobserver') in ['yes', 'on']:
+        cmdopt.jobserver = True
+    for timeout in readOptions(config, section, 'timeouts').split(','):
+        if timeout.strip() != '':
+            step = timeout.split('=', 1)[0].strip()
+            if '=' not in timeout:
+                step = ''
+            if step not in cmdopt.timeouts:
+                parseTimeout(timeout, cmdopt.timeouts)
+    for mirror in readOptions(config, section, 'mirrors').split(','):
+        if mirror.strip() != '' and mirror.strip() not in cmdopt.mirrors:
+            cmdopt.mirrors.append(mirror.strip())
+    # Known sha256 checksums of source tarballs, by file name.
+    if config.has_section('checksums'):
+        for name, value in config.items('checksums'):
+            cmdopt.checksums[name] = value
+
+    if cmdopt.sysroot == '':
+        sysroot  = readOptions(config, section, 'sysroot')
+        if sysroot == 'no' or sysroot == 'off':
+            cmdopt.sysroot = False
+        else:
+            cmdopt.sysroot = True
+
+    if cmdopt.builtin == '':
+        buildConfig.target   = readOptions(config, section, 'target')
+        buildConfig.triple   = readOptions(config, section, 'triple')
+        buildConfig.fpu      = readOptions(config, section, 'fpu')
+        buildConfig.floatabi = readOptions(config, section, 'floatabi')
+        buildConfig.abi      = readOptions(config, section, 'abi')
+        buildConfig.cpu      = readOptions(config, section, 'cpu')
+        buildConfig.arch     = readOptions(config, section, 'arch')
+
+
+# Environment of the stages which use the new toolchain, ${PREFIX}/bin is
+# prepended to PATH.
+def toolEnv(buildConfig):
+    env = baseEnv()
+    newBin = os.path.abspath(buildConfig.prefix + '/bin')
+    env['PATH'] = newBin + ':' + env.get('PATH', '')
+    return env
+
+# Environment of the commands of a build stage, see toolEnv() for 'tools'
+# and launcherEnv() for 'target'.
+def stageEnv(buildConfig, tools=True, target=False):
+    if tools:
+        env = toolEnv(buildConfig)
+    else:
+        env = baseEnv()
+    env = launcherEnv(buildConfig, env, target)
+    if usesJobserver(buildConfig):
+        buildConfig.options.jobserver.setEnv(env)
+    return env
+
+# The jobserver pipe only reaches the make processes of this host.
+def usesJobserver(buildConfig):
+    return (buildConfig.options.jobserver is not None and
+            currentExecutor() is localExecutor)
+
+# Environment of the stage commands. The environment of the process is left
+# alone, every command gets its own copy.
+def baseEnv():
+    env = dict(os.environ)
+    # If *_INCLUDE_PATH was set, something went wrong. So unset them.
+    env.pop('C_INCLUDE_PATH', None)
+    env.pop('CPLUS_INCLUDE_PATH', None)
+    return env
+
+# Wrap the compilers with the compiler launcher (ccache, sccache...). Host
+# compilers are wrapped, and the new cross compilers for the 'target' side
+# stages. Compilers invoked by gcc's own build (xgcc for libgcc) are left
+# alone, they change with every gcc build.
+def launcherEnv(buildConfig, env, target=False):
+    launcher = buildConfig.options.launcher
+    if launcher == '':
+        return env
+    if target:
+        cc  = buildConfig.triple + '-gcc'
+        cxx = buildConfig.triple + '-g++'
+    else:
+        cc  = env.get('CC', 'gcc')
+        cxx = env.get('CXX', 'g++')
+    env['CC']  = launcher + ' ' + cc
+    env['CXX'] = launcher + ' ' + cxx
+    launcherDir = buildConfig.options.launcherDir
+    if os.path.basename(launcher).startswith('sccache'):
+        env['SCCACHE_DIR'] = launcherDir
+    else:
+        env['CCACHE_DIR'] = launcherDir
+        # Hash paths relative to the workdir, so the cache is shared with
+        # other workdirs.
+        env['CCACHE_BASEDIR'] = buildConfig.workdir
+    return env
+
+# Environment of the launcher's own commands on the cache 'launcherDir'.
+# sccache runs a server which takes its directory from the command starting
+# it, the one resetting the statistics before the build, and keeps the
+# statistics of all its directories together.
+def launcherCacheEnv(launcher, launcherDir):
+    env = baseEnv()
+    if os.path.basename(launcher).startswith('sccache'):
+        env['SCCACHE_DIR'] = launcherDir
+    else:
+        env['CCACHE_DIR'] = launcherDir
+    return env
+
+# Reset the statistics of the compiler launcher cache.
+def zeroLauncherStats(launcher, launcherDir):
+    env = launcherCacheEnv(launcher, launcherDir)
+    devnull = open(os.devnull, 'w')
+    try:
+        if os.path.basename(launcher).startswith('sccache'):
+            subprocess.call([launcher, '--zero-stats'], stdout=devnull, env=env)
+        else:
+            subprocess.call([launcher, '-z'], stdout=devnull, env=env)
+    finally:
+        devnull.close()
+
+# Return the hits and misses of the compiler launcher cache, None if they
+# can't be read.
+def launcherStats(launcher, launcherDir):
+    env = launcherCacheEnv(launcher, launcherDir)
+    try:
+        if os.path.basename(launcher).startswith('sccache'):
+            proc = subprocess.Popen([launcher, '--show-stats', '--stats-format=json'],
+                                    stdout=subprocess.PIPE, env=env)
+            stats = json.loads(proc.communicate()[0])['stats']
+            return (sum(stats['cache_hits']['counts'].values()),
+                    sum(stats['cache_misses']['counts'].values()))
+        # ccache >= 3.7 prints machine readable statistics.
+        proc = subprocess.Popen([launcher, '--print-stats'], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        output = proc.communicate()[0]
+        if proc.returncode == 0:
+            stats = dict([line.split('\t') for line in output.splitlines() if '\t' in line])
+            hits = (int(stats.get('direct_cache_hit', 0)) +
+                    int(stats.get('preprocessed_cache_hit', 0)))
+            return hits, int(stats.get('cache_miss', 0))
+        proc = subprocess.Popen([launcher, '-s'], stdout=subprocess.PIPE, env=env)
+        hits, misses = 0, 0
+        for line in proc.communicate()[0].splitlines():
+            numbers = re.findall(r'\d+', line)
+            if not numbers:
+                continue
+            if line.startswith('cache hit'):
+                hits = hits + int(numbers[0])
+            elif line.startswith('cache miss'):
+                misses = int(numbers[0])
+        return hits, misses
+    except (OSError, ValueError, KeyError):
+        return None
+
+def printHelpMessage():
+    helpMsg = """Usage: toolchainbot [OPTIONS] ...
+build a cross toolchain automaticly.
+
+    -h, --help              Print this help message
+    -l, --list              List all supported builtin toolchain
+        --combinations=name Print the known good combinations of versions of
+                            a builtin target, or a comma separated list of
+                            them or 'all', one per line.
+        --config=filename   Use configuration file. A [matrix] section builds
+                            every combination of the versions it lists, the
+                            stages they have in common are built once.
+        --prefix=path       Set installation path
+        --builtin=name      Build a builtin toolchain, must specify installation
+                            path use --prefix option. Several toolchains are
+                            built together with a comma separated list or
+                            'all', each of them is installed into a sub
+                            directory of the prefix.
+        --jobs=number       Specifies the number of jobs to run simultaneously,
+                            shared by all the stages running concurrently.
+                            With 'auto', use all the CPUs and size the jobs of
+                            every stage after the available memory and the
+                            memory its jobs used in the previous build.
+        --package=dir       Package every toolchain built into dir: strip the
+                            binaries, hard link identical files, write a
+                            manifest of the file hashes and archive it.
+        --package-format=fmt
+                            Compression of the packages : zst (default if
+                            zstd is installed), xz or gz.
+        --deploy=package    Unpack a package into the prefix and check it
+                            against its manifest, nothing is built.
+        --serve=[host:]port Run as a build service on this address, localhost by
+                            default. Builds are requested with a POST of
+                            {"builtin": name, "gcc": version, ...} to /builds,
+                            followed at /builds/<id>, their package is at
+                            /builds/<id>/artifact. Identical requests share
+                            one build.
+        --serve-dir=dir     Root directory of the service : build workdirs,
+                            shared sources and stage cache.
+        --serve-builds=number
+                            Number of builds the service runs at once, they
+                            share the jobs.
+        --worker=[host:]port
+                            Run as a build host on this address, localhost by
+                            default, for the bots given it with --remote. It
+                            runs any command sent by a bot with its token.
+                            The connections are not encrypted, keep it on a
+                            trusted network.
+        --worker-token=file File of the secret shared by a worker and its bots,
+                            ~/.toolchainbot-worker-token by default. The
+                            worker creates it if missing, it must not be
+                            readable by other users.
+        --remote=host:port  Run stages on this worker too, the stages which
+                            install files (binutils, gcc, glibc) go to the host
+                            with the most free jobs. The worker uses the same
+                            paths and tools, the source trees and the prefix
+                            are synchronized with it. May be repeated.
+        --timeout=[step=]seconds
+                            Kill the commands of a step (configure, make,
+                            install...) running longer than this, of every
+                            step without 'step='. May be repeated.
+        --plan              Print what the build would do and nothing else :
+                            the commands of every stage, the stages restored
+                            from the cache or completed by a previous build,
+                            and the estimated time from previous builds.
+        --keep-going        Go on building the toolchains which don't depend on
+                            a failed stage, default with a [matrix] section in
+                            the configuration file.
+        --from=stage        Run the build again from this stage, by default a
+                            build resumes after the stages a previous build
+                            completed with the same inputs. May be repeated.
+        --skip=stage        Skip a stage, 'verify' skips building and checking
+                            test programs with the new toolchain. May be
+                            repeated.
+        --log-dir=dir       Write the output of every stage to dir/<stage>.log.gz,
+                            the default is the logs directory of the workdir.
+                            The last lines of a failed stage are printed.
+        --verbose           Print the output of the commands instead of
+                            writing it to the stage logs.
+        --jobserver         Share a GNU make jobserver between all the make
+                            processes.
+        --extract-jobs=number
+                            Number of source tarballs to decompress
+                            simultaneously, same as --jobs by default.
+        --cache-dir=path    Cache the files installed by each stage, a stage
+                            is restored from the cache when its sources,
+                            configuration and upstream stages are unchanged.
+        --incremental       Keep the build directories configured by the same
+                            command on the same source tree, and only run make
+                            in them.
+        --mirror=url        Download missing source tarballs from this mirror,
+                            before the default ones. May be given several times,
+                            http://, https:// and file:// are supported.
+        --shared-cache=path Share downloaded tarballs and extracted source trees
+                            between workdirs, the trees are reflink copied or
+                            hard linked into the workdir.
+        --launcher=program  Compiler launcher (ccache, sccache) wrapping the host
+                            compilers, and the cross compiler for glibc.
+        --launcher-dir=path Cache directory of the launcher, each toolchain
+                            uses a sub directory named after its triple. A
+                            sccache server serves the whole build from the
+                            directory of the first toolchain, its hit rate is
+                            the one of the server.
+        --scratch=path      Put the object trees on fast local storage (tmpfs,
+                            local SSD) when it has room for them, they are
+                            removed once installed.
+        --report=filename   Write the time, CPU, peak memory and I/O of every
+                            step into a JSON file, or a CSV file if the name
+                            ends with '.csv'.
+"""
+    print(helpMsg)
+    sys.exit(0)
+
+# Print the builtin targets with their default and known versions.
 def printBuiltinList():
+    for name in sorted(builtinTarget.keys()):
+        config = builtinTarget[name]
+        print(name + ' (' + config['triple'] + ')')
+        for package in versionPackages:
+            print('    %-10s %-8s %s' % (package, config['default-' + package],
+                                       ' '.join(versionIndex.range(name, package))))
+        print('    ' + str(len(versionIndex.combinations(name))) + ' valid combinations')
+    sys.exit(0)
+
+# Print every valid version combination of the builtin targets, one per
+# line, for matrix builds.
+def printCombinations(builtins):
+    for name in builtins:
+        for combo in versionIndex.combinations(name):
+            print(' '.join([name] + [package + '=' + combo[package]
+                                     for package in versionPackages]))
     sys.exit(0)
 
 class CmdLineOptions:
     prefix = ''
     config = ''
-    skipList = []
     builtin = ''
     sysroot = ''
     jobs    = 4
+    # Directory and format (zst, xz or gz) of the toolchain packages.
+    package = ''
+    packageFormat = ''
+    # Address, root directory and concurrent builds of the build service.
+    serve   = ''
+    serveDir = '.'
+    serveBuilds = 1
+    # Address of the worker agent to run, see workerServe(), and the file of
+    # the token its bots need, see readWorkerToken().
+    worker  = ''
+    workerToken = ''
+    # Go on building the toolchains which don't depend on a failed stage.
+    keepGoing = False
+    # Print the plan of the build instead of building.
+    plan    = False
+    # Package to deploy into the prefix instead of building.
+    deploy  = ''
+    # Directory of the stage logs, the output goes to the terminal if empty.
+    logDir  = ''
+    verbose = False
+    # Size the jobs of every stage from the CPUs and the available memory.
+    autoJobs = False
+    jobserver = False
+    # Number of tarballs decompressed simultaneously, 0 means --jobs.
+    extractJobs = 0
+    cacheDir = ''
+    incremental = False
+    report  = ''
+    sharedCache = ''
+    launcher = ''
+    launcherDir = ''
+    scratch = ''
+
+    # The lists and dicts are per instance, class attributes would be shared
+    # by every CmdLineOptions.
+    def __init__(self):
+        self.skipList  = []
+        self.mirrors   = []
+        self.checksums = {}
+        # Addresses of the workers the stages may run on.
+        self.remotes   = []
+        # Stages to run again even if a previous build completed them.
+        self.fromStages = []
+        # Timeout of the steps in seconds, see ProcessEngine.timeout().
+        self.timeouts  = {}
+
+# Add a timeout '[step=]seconds' to 'timeouts', exit if it is wrong.
+def parseTimeout(value, timeouts):
+    step = ''
+    seconds = value
+    if '=' in value:
+        step, seconds = value.split('=', 1)
+    try:
+        timeouts[step.strip()] = int(seconds)
+    except ValueError:
+        print('Error ! Wrong timeout : ' + value)
+        sys.exit(1)
+
+# Names of the builtin targets given to --builtin, a comma separated list
+# or 'all'.
+def builtinNames(builtin):
+    if builtin == 'all':
+        names = builtinTarget.keys()
+        names.sort()
+        return names
+    return [name for name in builtin.split(',') if name != '']
 
 # Handle command line options.
 def handleOptions():
@@ -539,16 +3505,26 @@ def handleOptions():
             optionsList, others = getopt.getopt(sys.argv[1:], 'lh',
                                                 ['list', 'help',
                                                  'config=', 'skip=', 'builtin=',
-                                                 'prefix=', 'sysroot=', 'jobs='])
+                                                 'prefix=', 'sysroot=', 'jobs=',
+                                                 'extract-jobs=', 'cache-dir=',
+                                                 'incremental', 'report=',
+                                                 'mirror=', 'shared-cache=',
+                                                 'launcher=', 'launcher-dir=',
+                                                 'scratch=', 'jobserver', 'log-dir=',
+                                                 'verbose', 'package=', 'package-format=',
+                                                 'deploy=', 'from=', 'combinations=',
+                                                 'keep-going', 'plan', 'serve=', 'serve-dir=',
+                                                 'serve-builds=', 'worker=', 'worker-token=', 'remote=',
+                                                 'timeout='])
         except getopt.GetoptError, exc:
             # When wrong options was gaven, report the error.
             print(exc.msg)
             sys.exit(1)
         for item in optionsList:
-            if item[0] == '-l':
+            if item[0] in ['-l', '--list']:
                 showBuiltinList = True
                 break
-            elif item[0] == '-h':
+            elif item[0] in ['-h', '--help']:
                 showHelpMsg = True
                 break
             elif item[0] == '--prefix':
@@ -566,11 +3542,85 @@ def handleOptions():
                     cmdopt.sysroot = False
                 else:
                     print('Warning : Bad value for sysroot option, use \'yes\' by default.')
+            elif item[0] == '--jobs' and item[1] == 'auto':
+                cmdopt.autoJobs = True
+                cmdopt.jobs = multiprocessing.cpu_count()
             elif item[0] == '--jobs':
+                try:
+                    cmdopt.jobs = int(item[1])
+                except:
+                    cmdopt.jobs = 0
+                if cmdopt.jobs < 1:
+                    print('Error ! --jobs needs a number of at least 1 or auto.')
+                    sys.exit(1)
+            elif item[0] == '--package':
+                cmdopt.package = item[1]
+            elif item[0] == '--package-format':
+                if item[1] not in packageCompressor:
+                    print('Error ! Package format must be one of ' +
+                          ', '.join(sorted(packageCompressor.keys())) + '.')
+                    sys.exit(1)
+                cmdopt.packageFormat = item[1]
+            elif item[0] == '--combinations':
+                combinations = builtinNames(item[1])
+                for name in combinations:
+                    if name not in builtinTarget:
+                        print('Error ! Wrong buili-in target.\n')
+                        sys.exit(1)
+                printCombinations(combinations)
+            elif item[0] == '--serve':
+                cmdopt.serve = item[1]
+            elif item[0] == '--serve-dir':
+                cmdopt.serveDir = item[1]
+            elif item[0] == '--serve-builds':
+                try:
+                    cmdopt.serveBuilds = int(item[1])
+                except:
+                    print('Error ! --serve-builds needs a number.')
+                    sys.exit(1)
+            elif item[0] == '--worker':
+                cmdopt.worker = item[1]
+            elif item[0] == '--worker-token':
+                cmdopt.workerToken = item[1]
+            elif item[0] == '--remote':
+                cmdopt.remotes.append(item[1])
+            elif item[0] == '--timeout':
+                parseTimeout(item[1], cmdopt.timeouts)
+            elif item[0] == '--plan':
+                cmdopt.plan = True
+            elif item[0] == '--keep-going':
+                cmdopt.keepGoing = True
+            elif item[0] == '--from':
+                cmdopt.fromStages.append(item[1])
+            elif item[0] == '--deploy':
+                cmdopt.deploy = item[1]
+            elif item[0] == '--log-dir':
+                cmdopt.logDir = item[1]
+            elif item[0] == '--verbose':
+                cmdopt.verbose = True
+            elif item[0] == '--jobserver':
+                cmdopt.jobserver = True
+            elif item[0] == '--scratch':
+                cmdopt.scratch = item[1]
+            elif item[0] == '--launcher':
+                cmdopt.launcher = item[1]
+            elif item[0] == '--launcher-dir':
+                cmdopt.launcherDir = item[1]
+            elif item[0] == '--shared-cache':
+                cmdopt.sharedCache = item[1]
+            elif item[0] == '--mirror':
+                cmdopt.mirrors.append(item[1])
+            elif item[0] == '--report':
+                cmdopt.report = item[1]
+            elif item[0] == '--incremental':
+                cmdopt.incremental = True
+            elif item[0] == '--cache-dir':
+                cmdopt.cacheDir = item[1]
+            elif item[0] == '--extract-jobs':
                 try:
                     jobs = int(item[1])
-                    if jobs > 1:
-                        cmdopt.jobs = jobs
+                    if jobs > 0:
+                        cmdopt.extractJobs = jobs
                 except:
                     pass
     else:
@@ -579,12 +3629,23 @@ def handleOptions():
         printHelpMessage()
     if showBuiltinList:
         printBuiltinList()
-    if cmdopt.builtin != '':
-        if cmdopt.builtin not in builtinTarget:
-            # Wrong built-in target.
-            print('Error ! Wrong buili-in target.\n')
-            print('Use -l option to get all of supported builtin target.')
+    if cmdopt.packageFormat == '':
+        cmdopt.packageFormat = defaultPackageFormat()
+    if cmdopt.serve != '' or cmdopt.worker != '':
+        return cmdopt
+    if cmdopt.deploy != '':
+        if cmdopt.prefix == '':
+            print('Error ! You didn\'t specify \'prefix\' option.\n')
+            print('\'prefix\' option tells where to deploy the package.')
             sys.exit(1)
+        return cmdopt
+    if cmdopt.builtin != '':
+        for name in builtinNames(cmdopt.builtin):
+            if name not in builtinTarget:
+                # Wrong built-in target.
+                print('Error ! Wrong buili-in target.\n')
+                print('Use -l option to get all of supported builtin target.')
+                sys.exit(1)
         if cmdopt.prefix == '':
             # Empty 'prefix' when using built-in target is not permitted.
             print('Error ! You didn\'t specify \'prefix\' option.\n')
@@ -598,36 +3659,961 @@ def handleOptions():
             sys.exit(0)
     return cmdopt
 
+# A build service: it takes toolchain build requests over HTTP, runs each
+# distinct request once in its own workdir, and keeps the source trees and the
+# stage cache of its root directory warm for the next requests. Identical
+# requests, queued, running or finished, get the same build.
+class BuildService:
+    def __init__(self, root, slots, cmdopt):
+        self.root   = os.path.abspath(root)
+        self.slots  = max(1, slots)
+        self.cmdopt = cmdopt
+        self.lock   = threading.Lock()
+        self.queue  = Queue.Queue()
+        self.builds = {}
+        for name in ['builds', 'shared', 'cache']:
+            if not os.path.exists(self.root + '/' + name):
+                os.makedirs(self.root + '/' + name)
+        try:
+            f = open(self.root + '/builds.json')
+            try:
+                self.builds = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+        # The builds a previous daemon did not finish are run again.
+        for build in self.builds.values():
+            if build['state'] in ['queued', 'running']:
+                build['state'] = 'queued'
+                self.queue.put(build['id'])
+
+    def save(self):
+        f = open(self.root + '/builds.json.tmp', 'w')
+        try:
+            json.dump(self.builds, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(self.root + '/builds.json.tmp', self.root + '/builds.json')
+
+    # Check a request and complete it with the default versions, return
+    # None if it is not valid.
+    def normalize(self, request):
+        builtin = request.get('builtin', '')
+        if builtin not in builtinTarget:
+            return None
+        normalized = {'builtin': builtin}
+        for package in versionPackages:
+            version = str(request.get(package, builtinTarget[builtin]['default-' + package]))
+            if not re.match(r'^\d+(\.\d+){1,2}$', version):
+                return None
+            normalized[package] = version
+        if not versionIndex.accepts(builtin, normalized):
+            return None
+        return normalized
+
+    # Return the build of a normalized request, queue it if it is new.
+    def submit(self, request):
+        key = hashlib.sha256(json.dumps(request, sort_keys=True)).hexdigest()
+        self.lock.acquire()
+        try:
+            build = self.builds.get(key[:16])
+            if build is None or build['state'] == 'failed':
+                build = {'id': key[:16], 'request': request, 'state': 'queued',
+                         'submitted': time.time(), 'artifact': ''}
+                self.builds[build['id']] = build
+                self.save()
+                self.queue.put(build['id'])
+            return dict(build)
+        finally:
+            self.lock.release()
+
+    def status(self, id):
+        self.lock.acquire()
+        try:
+            if id not in self.builds:
+                return None
+            return dict(self.builds[id])
+        finally:
+            self.lock.release()
+
+    def directory(self, id):
+        return self.root + '/builds/' + id
+
+    # Run a build in a child bot, so that a failing build can't take the
+    # daemon down. The child shares the source trees and the stage cache of
+    # the root, its output goes to bot.log in the build directory.
+    def run(self, build):
+        path = self.directory(build['id'])
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        config = open(path + '/request.ini', 'w')
+        try:
+            config.write('[default]\n')
+            for package in versionPackages:
+                config.write(package + ' = ' + build['request'][package] + '\n')
+        finally:
+            config.close()
+        args = [sys.executable, os.path.abspath(__file__),
+                '--config=request.ini', '--builtin=' + build['request']['builtin'],
+                '--prefix=' + path + '/install', '--package=' + path + '/package',
+                '--jobs=' + str(max(1, self.cmdopt.jobs // self.slots)),
+                '--shared-cache=' + self.root + '/shared',
+                '--cache-dir=' + self.root + '/cache']
+        args.extend(['--mirror=' + mirror for mirror in self.cmdopt.mirrors])
+        args.extend(['--remote=' + remote for remote in self.cmdopt.remotes])
+        if self.cmdopt.workerToken != '':
+            args.append('--worker-token=' + self.cmdopt.workerToken)
+        args.extend(['--timeout=' + (step and step + '=') + str(seconds)
+                     for step, seconds in self.cmdopt.timeouts.items()])
+        if self.cmdopt.launcher != '':
+            args.append('--launcher=' + self.cmdopt.launcher)
+        log = open(path + '/bot.log', 'w')
+        try:
+            ret = subprocess.call(args, cwd=path, stdout=log, stderr=subprocess.STDOUT)
+        finally:
+            log.close()
+        artifact = ''
+        if ret == 0 and os.path.exists(path + '/package'):
+            files = os.listdir(path + '/package')
+            if len(files) == 1:
+                artifact = path + '/package/' + files[0]
+        return ret, artifact
+
+    def worker(self):
+        while True:
+            id = self.queue.get()
+            self.lock.acquire()
+            build = self.builds[id]
+            build['state'] = 'running'
+            build['started'] = time.time()
+            self.save()
+            self.lock.release()
+            printMessage('Build ' + id + ' : ' + json.dumps(build['request'], sort_keys=True))
+            try:
+                ret, artifact = self.run(build)
+            except Exception:
+                printMessage(traceback.format_exc())
+                ret, artifact = -1, ''
+            self.lock.acquire()
+            build['returncode'] = ret
+            build['artifact'] = artifact
+            build['finished'] = time.time()
+            build['state'] = artifact != '' and 'done' or 'failed'
+            self.save()
+            self.lock.release()
+            printMessage('Build ' + id + ' ' + build['state'])
+
+    def start(self):
+        for i in range(self.slots):
+            thread = threading.Thread(target=self.worker)
+            thread.daemon = True
+            thread.start()
+
+# HTTP interface of the build service:
+#   POST /builds                 {"builtin": "aarch64", "gcc": "4.8.2", ...}
+#   GET  /builds                 every build
+#   GET  /builds/<id>            state of a build
+#   GET  /builds/<id>/log        output of the bot
+#   GET  /builds/<id>/artifact   the toolchain package
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def sendJson(self, code, value):
+        data = json.dumps(value, indent=2, sort_keys=True) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def sendFile(self, path, contentType):
+        f = open(path, 'rb')
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', contentType)
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+        finally:
+            f.close()
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path.rstrip('/') != '/builds':
+            self.sendJson(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length', '0'))
+            request = service.normalize(json.loads(self.rfile.read(length)))
+        except (ValueError, AttributeError):
+            request = None
+        if request is None:
+            self.sendJson(400, {'error': 'bad request'})
+            return
+        self.sendJson(202, service.submit(request))
+
+    def do_GET(self):
+        service = self.server.service
+        parts = [part for part in self.path.split('?')[0].split('/') if part != '']
+        if parts == ['builds']:
+            service.lock.acquire()
+            try:
+                builds = [dict(build) for build in service.builds.values()]
+            finally:
+                service.lock.release()
+            self.sendJson(200, builds)
+            return
+        if len(parts) < 2 or parts[0] != 'builds' or len(parts) > 3:
+            self.sendJson(404, {'error': 'not found'})
+            return
+        build = service.status(parts[1])
+        if build is None:
+            self.sendJson(404, {'error': 'no build ' + parts[1]})
+        elif len(parts) == 2:
+            self.sendJson(200, build)
+        elif parts[2] == 'log' and os.path.exists(service.directory(build['id']) + '/bot.log'):
+            self.sendFile(service.directory(build['id']) + '/bot.log', 'text/plain')
+        elif parts[2] == 'artifact' and build['state'] == 'done':
+            self.sendFile(build['artifact'], 'application/octet-stream')
+        else:
+            self.sendJson(404, {'error': 'not available'})
+
+class ServiceServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# Return the (host, port) of an address [host:]port, the host defaults to
+# localhost.
+def parseAddress(address):
+    host = '127.0.0.1'
+    port = address
+    if ':' in port:
+        host, port = port.rsplit(':', 1)
+    try:
+        return host, int(port)
+    except ValueError:
+        print('Error ! Wrong address : ' + address)
+        sys.exit(1)
+
+# Run the build service until interrupted.
+def serve(cmdopt):
+    host, port = parseAddress(cmdopt.serve)
+    service = BuildService(cmdopt.serveDir, cmdopt.serveBuilds, cmdopt)
+    server = ServiceServer((host, port), ServiceHandler)
+    server.service = service
+    service.start()
+    printMessage('Serving builds on ' + host + ':' + str(port) + ' from ' + service.root)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+# Default file of the secret shared by a worker and its bots.
+workerTokenName = '~/.toolchainbot-worker-token'
+
+# Read the worker token from 'path', the default file if empty. The worker
+# creates the file if it is missing. Nobody but its owner may read it.
+def readWorkerToken(path, create=False):
+    path = os.path.expanduser(path or workerTokenName)
+    if create and not os.path.exists(path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+        try:
+            os.write(fd, os.urandom(32).encode('hex') + '\n')
+        finally:
+            os.close(fd)
+        printMessage('Worker token written to ' + path + ', copy it to the hosts of the bots')
+    try:
+        if os.stat(path).st_mode & 0077:
+            print('Error ! ' + path + ' can be read by other users, chmod it to 600.')
+            sys.exit(1)
+        f = open(path)
+        try:
+            token = f.read().strip()
+        finally:
+            f.close()
+    except (IOError, OSError), exc:
+        print('Error ! No worker token : ' + str(exc))
+        sys.exit(1)
+    if token == '':
+        print('Error ! The worker token ' + path + ' is empty.')
+        sys.exit(1)
+    return token
+
+# Answer to the challenge of a worker, the token itself is never sent.
+def tokenProof(token, nonce):
+    return hmac.new(token, nonce, hashlib.sha256).hexdigest()
+
+# Frames of the worker protocol: a JSON header line, followed by 'size' bytes
+# of data if the header has a size.
+def sendFrame(wfile, header, data=''):
+    if data:
+        header = dict(header, size=len(data))
+    wfile.write(json.dumps(header) + '\n' + data)
+    wfile.flush()
+
+def recvFrame(rfile):
+    line = rfile.readline()
+    if not line:
+        raise IOError('connection closed')
+    header = json.loads(line)
+    data = ''
+    if header.get('size', 0) > 0:
+        data = rfile.read(header['size'])
+        if len(data) < header['size']:
+            raise IOError('connection closed')
+    return header, data
+
+# Send the files of 'root' as a tar archive in data frames, followed by an
+# end frame.
+def sendTree(wfile, root, files):
+    fileList = tempfile.NamedTemporaryFile()
+    try:
+        fileList.write('\0'.join(files))
+        fileList.flush()
+        # The POSIX format keeps the exact mtimes, compared by snapshotTree().
+        proc = subprocess.Popen(['tar', 'cf', '-', '--format=posix', '-C', root,
+                                 '--no-recursion', '--null', '-T', fileList.name],
+                                stdout=subprocess.PIPE)
+        try:
+            while True:
+                data = proc.stdout.read(1 << 20)
+                if not data:
+                    break
+                sendFrame(wfile, {'type': 'data'}, data)
+        finally:
+            proc.stdout.close()
+            ret = proc.wait()
+    finally:
+        fileList.close()
+    sendFrame(wfile, {'type': 'end', 'code': ret})
+
+# Extract the tar archive of the data frames into 'root', return True if
+# it was sent and extracted completely.
+def receiveTree(rfile, root):
+    if not os.path.exists(root):
+        os.makedirs(root)
+    proc = subprocess.Popen(['tar', 'xf', '-', '-C', root], stdin=subprocess.PIPE)
+    broken = False
+    try:
+        while True:
+            header, data = recvFrame(rfile)
+            if header['type'] != 'data':
+                break
+            if not broken:
+                try:
+                    proc.stdin.write(data)
+                except IOError:
+                    # tar failed, the rest of the archive is read anyway.
+                    broken = True
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        ret = proc.wait()
+    return ret == 0 and header.get('code', 0) == 0
+
+# Remove the files and directories of 'root' listed in 'names'.
+def removeFiles(root, names):
+    for name in sorted(names, reverse=True):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, True)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+# A build host running 'toolchainbot --worker'. The worker runs at the same
+# paths as this host and with the same tools; the trees a stage reads are
+# mirrored to it by comparing snapshots of both sides, so that only the
+# files which changed are sent, and the files the stage installed are pulled
+# back the same way. Every request uses its own connection.
+class WorkerExecutor:
+    def __init__(self, address, token):
+        self.address = parseAddress(address)
+        self.name = address
+        self.token = token
+        try:
+            reply, data = self.call({'op': 'hello'})
+        except (IOError, socket.error), exc:
+            print('Error ! No worker at ' + address + ' : ' + str(exc))
+            sys.exit(1)
+        self.jobs = reply['jobs']
+        printMessage('Worker ' + address + ' (' + reply['host'] + ') : ' +
+                     str(self.jobs) + ' jobs')
+
+    # Connect to the worker and answer its challenge.
+    def connect(self):
+        sock = socket.create_connection(self.address)
+        rfile = sock.makefile('rb', 1 << 16)
+        wfile = sock.makefile('wb', 1 << 16)
+        try:
+            challenge, data = recvFrame(rfile)
+            sendFrame(wfile, {'op': 'auth',
+                              'proof': tokenProof(self.token, str(challenge['nonce']))})
+            reply, data = recvFrame(rfile)
+            if not reply.get('ok'):
+                raise IOError('the worker refused the token')
+        except:
+            rfile.close()
+            wfile.close()
+            sock.close()
+            raise
+        return sock, rfile, wfile
+
+    # Send a request, return the reply of the worker.
+    def call(self, request):
+        sock, rfile, wfile = self.connect()
+        try:
+            sendFrame(wfile, request)
+            return recvFrame(rfile)
+        finally:
+            rfile.close()
+            wfile.close()
+            sock.close()
+
+    def failed(self, what, exc):
+        printMessage('Error ! Worker ' + self.name + ' : ' + what + ' : ' + str(exc))
+        sys.exit(1)
+
+    def run(self, args, stage, step, cwd=None, env=None):
+        if env is None:
+            env = baseEnv()
+        # The jobserver pipe of this host means nothing over there.
+        env = dict(env)
+        env.pop('MAKEFLAGS', None)
+        env.pop('MFLAGS', None)
+        try:
+            sock, rfile, wfile = self.connect()
+            # Cancelling the stage closes the connection, the worker kills
+            # the command.
+            def cancel():
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            processEngine.watch(stage, cancel)
+            try:
+                sendFrame(wfile, {'op': 'run', 'args': args, 'cwd': cwd, 'env': env,
+                                  'timeout': processEngine.timeout(step)})
+                reply = {}
+                def read():
+                    header, data = recvFrame(rfile)
+                    if header['type'] == 'output':
+                        return data
+                    reply.update(header)
+                    return ''
+                if buildLogs.directory == '':
+                    data = read()
+                    while data:
+                        sys.stdout.write(data)
+                        data = read()
+                else:
+                    buildLogs.record(read, stage, step)
+            finally:
+                processEngine.unwatch(stage)
+                rfile.close()
+                wfile.close()
+                sock.close()
+        except (IOError, socket.error, ValueError), exc:
+            if processEngine.cancelReason(stage) != '':
+                printMessage('Kill ' + step + ' ' + stage + ' : ' +
+                             processEngine.cancelReason(stage))
+                return -signal.SIGTERM, noUsage
+            self.failed(step + ' ' + stage, exc)
+        if reply.get('killed', '') != '':
+            printMessage('Kill ' + step + ' ' + stage + ' on ' + self.name + ' : ' +
+                         reply['killed'])
+        return reply['code'], RemoteUsage(*reply['usage'])
+
+    # Make an empty directory on the worker.
+    def fresh(self, path, stage):
+        try:
+            reply, data = self.call({'op': 'fresh', 'path': path})
+        except (IOError, socket.error, ValueError), exc:
+            self.failed(stage, exc)
+        if not reply['ok']:
+            print('Error when building ' + stage + '.')
+            sys.exit(1)
+
+    def snapshot(self, root, excludes):
+        reply, data = self.call({'op': 'snapshot', 'root': root, 'excludes': excludes})
+        snapshot = {}
+        for name, info in json.loads(data).items():
+            snapshot[name] = tuple(info)
+        return snapshot
+
+    # Make the tree 'root' of the worker the same as here.
+    def push(self, root, excludes=[]):
+        try:
+            remote = self.snapshot(root, excludes)
+            local = snapshotTree(root, excludes)
+            files = changedFiles(remote, local)
+            extra = [name for name in remote if name not in local]
+            if not files and not extra:
+                return
+            printMessage('Push ' + str(len(files)) + ' files of ' + root + ' to ' + self.name)
+            sock, rfile, wfile = self.connect()
+            try:
+                sendFrame(wfile, {'op': 'put', 'root': root, 'remove': extra})
+                sendTree(wfile, root, files)
+                reply, data = recvFrame(rfile)
+            finally:
+                rfile.close()
+                wfile.close()
+                sock.close()
+        except (IOError, socket.error, ValueError), exc:
+            self.failed('push ' + root, exc)
+        if not reply['ok']:
+            self.failed('push ' + root, 'extraction failed')
+
+    # Fetch the files of the tree 'root' of the worker which differ here.
+    def pull(self, root, excludes=[]):
+        try:
+            files = changedFiles(snapshotTree(root, excludes), self.snapshot(root, excludes))
+            if not files:
+                return
+            printMessage('Pull ' + str(len(files)) + ' files of ' + root + ' from ' + self.name)
+            sock, rfile, wfile = self.connect()
+            try:
+                sendFrame(wfile, {'op': 'get', 'root': root, 'files': files})
+                ok = receiveTree(rfile, root)
+            finally:
+                rfile.close()
+                wfile.close()
+                sock.close()
+        except (IOError, socket.error, ValueError), exc:
+            self.failed('pull ' + root, exc)
+        if not ok:
+            self.failed('pull ' + root, 'extraction failed')
+
+# The worker side, one request per connection.
+class WorkerHandler(SocketServer.StreamRequestHandler):
+    # Output chunks (up to 64k) of a command waiting to be sent.
+    queuedChunks = 1024
+
+    def handle(self):
+        try:
+            # A bot proves it has the token before any request, by its answer
+            # to a random challenge.
+            nonce = os.urandom(16).encode('hex')
+            sendFrame(self.wfile, {'type': 'challenge', 'nonce': nonce})
+            request, data = recvFrame(self.rfile)
+            ok = hmac.compare_digest(str(request.get('proof', '')),
+                                     tokenProof(self.server.token, nonce))
+            sendFrame(self.wfile, {'type': 'auth', 'ok': ok})
+            if not ok:
+                printMessage('Worker : refused ' + self.client_address[0] + ', wrong token')
+                return
+            request, data = recvFrame(self.rfile)
+            op = request.get('op')
+            if op == 'hello':
+                sendFrame(self.wfile, {'type': 'hello', 'host': socket.gethostname(),
+                                       'jobs': self.server.jobs})
+            elif op == 'run':
+                self.run(request)
+            elif op == 'fresh':
+                ok = True
+                try:
+                    if os.path.exists(request['path']):
+                        shutil.rmtree(request['path'])
+                    os.makedirs(request['path'])
+                except OSError:
+                    ok = False
+                sendFrame(self.wfile, {'type': 'done', 'ok': ok})
+            elif op == 'snapshot':
+                snapshot = snapshotTree(request['root'], request['excludes'])
+                sendFrame(self.wfile, {'type': 'snapshot'}, json.dumps(snapshot))
+            elif op == 'put':
+                removeFiles(request['root'], request['remove'])
+                ok = receiveTree(self.rfile, request['root'])
+                sendFrame(self.wfile, {'type': 'done', 'ok': ok})
+            elif op == 'get':
+                sendTree(self.wfile, request['root'], request['files'])
+        except (IOError, socket.error, ValueError, KeyError):
+            # The bot went away or sent garbage.
+            pass
+
+    # Run a command, send its output as it comes and its exit code. The
+    # command is killed if the bot goes away or if it runs over its timeout.
+    def run(self, request):
+        # The engine thread only queues the output and this thread sends it,
+        # so a stalled bot doesn't stop the commands of the other bots. The
+        # command of a bot which doesn't read its output is killed.
+        chunks = Queue.Queue()
+        def output(data):
+            if chunks.qsize() >= self.queuedChunks:
+                raise IOError('the bot does not read the output')
+            chunks.put(data)
+        try:
+            job = processEngine.submit(request['args'], 'worker', 'run', request['cwd'],
+                                       request['env'], output, request.get('timeout', 0))
+        except OSError, exc:
+            sendFrame(self.wfile, {'type': 'output'}, str(exc) + '\n')
+            sendFrame(self.wfile, {'type': 'exit', 'code': 127, 'usage': list(noUsage)})
+            return
+        try:
+            while not job.done.isSet() or not chunks.empty():
+                try:
+                    sendFrame(self.wfile, {'type': 'output'}, chunks.get(True, 1))
+                    continue
+                except Queue.Empty:
+                    pass
+                # The bot sends nothing more, the connection becomes readable
+                # when it goes away.
+                if select.select([self.connection], [], [], 0)[0]:
+                    if self.connection.recv(1) == '':
+                        processEngine.kill(job, 'bot went away')
+        except (IOError, socket.error):
+            processEngine.kill(job, 'bot went away')
+            raise
+        ret, usage = job.wait()
+        sendFrame(self.wfile, {'type': 'exit', 'code': ret, 'killed': job.killed,
+                               'usage': [usage.ru_utime, usage.ru_stime, usage.ru_maxrss,
+                                         usage.ru_inblock, usage.ru_oublock]})
+
+class WorkerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# Run a worker agent until interrupted, the stages of bots given its address
+# with --remote run here. The bots with the worker token run commands as
+# this user.
+def workerServe(cmdopt):
+    host, port = parseAddress(cmdopt.worker)
+    token = readWorkerToken(cmdopt.workerToken, True)
+    server = WorkerServer((host, port), WorkerHandler)
+    server.token = token
+    server.jobs = cmdopt.jobs
+    printMessage('Worker on ' + host + ':' + str(port) + ' with ' + str(cmdopt.jobs) + ' jobs')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+# Time of the stages in seconds, until a build measured them on this machine.
+defaultDuration = {
+    'binutils' : 180,
+    'gcc1'     : 600,
+    'header'   : 5,
+    'glibc'    : 900,
+    'libpath'  : 1,
+    'gcc2'     : 1800,
+    'verify'   : 10,
+    'package'  : 120,
+}
+
+# Return the estimated time of a stage and whether it was measured.
+def stageDuration(history, name):
+    kind = stageKind(name)
+    if history.get(kind, {}).get('wall', 0) > 0:
+        return history[kind]['wall'], True
+    if kind.startswith('header-'):
+        return 30, False
+    return defaultDuration.get(kind, 60), False
+
+def formatDuration(seconds):
+    seconds = int(seconds + 0.5)
+    if seconds >= 3600:
+        return '%dh%02dm%02ds' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    if seconds >= 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%ds' % seconds
+
+# Print what the build would do without doing it: the sources to download,
+# for every stage what happens to it (run, restored from the cache, skipped,
+# or completed by a previous build), its commands and its estimated time,
+# and the time of the whole build.
+def printPlan(scheduler, buildConfigs, cmdopt):
+    history = readHistory(buildConfigs[0].workdir)
+    missing = []
+    for buildConfig in buildConfigs:
+        for name, version in sourcePackages(buildConfig):
+            fullName = name + '-' + version
+            if fullName in missing or name == 'glibc-ports':
+                continue
+            if os.path.exists(buildConfig.build + '/' + fullName):
+                continue
+            if sourceDigest(buildConfig, name, version) != fullName:
+                continue
+            missing.append(fullName)
+    if missing:
+        print('Download : ' + ' '.join(missing) + ' (the cache keys of their stages will change)')
+    finish  = {}
+    total   = 0.0
+    actions = {}
+    measured = True
+    pending = list(scheduler.stages)
+    while pending:
+        stage = [s for s in pending if all(d in finish for d in s.deps)][0]
+        pending.remove(stage)
+        start = max([0.0] + [finish[d] for d in stage.deps])
+        duration = 0.0
+        if stage.skip:
+            action = 'skip'
+        elif scheduler.resumable(stage):
+            action = 'completed'
+        elif scheduler.cache is not None and stage.root != '' and \
+                scheduler.cache.has(stage.key):
+            action = 'cache'
+            scheduler.ran.add(stage)
+        else:
+            action = 'run'
+            scheduler.ran.add(stage)
+            duration, known = stageDuration(history, stage.name)
+            measured = measured and known
+        actions[action] = actions.get(action, 0) + 1
+        finish[stage] = start + duration
+        total = total + duration
+        print('%-40s %-10s %8s  key %s' % (stage.name, action, formatDuration(duration),
+                                           stage.key[:12]))
+        if action != 'run' or stage.plan is None:
+            continue
+        jobs = stage.maxJobs or cmdopt.jobs
+        directory = ''
+        for step, args, cwd in stage.plan(jobs):
+            if cwd != directory and cwd != '':
+                print('    in ' + cwd)
+            directory = cwd
+            print('    %-20s %s' % (step, ' '.join([pipes.quote(arg) for arg in args
+                                                   if arg != ''])))
+    labels = {'run': 'to build', 'cache': 'from the cache', 'completed': 'completed',
+              'skip': 'skipped'}
+    print('Stages : ' + ', '.join(['%d %s' % (actions[a], labels[a])
+                                   for a in ['run', 'cache', 'completed', 'skip']
+                                   if a in actions]))
+    note = 'measured by previous builds'
+    if not measured:
+        note = 'some are default estimates'
+    print('Estimated time : ' + formatDuration(max([0.0] + finish.values())) +
+          ' with enough jobs, ' + formatDuration(total) + ' of stage time (' + note + ')')
+
+# Read the [matrix] section of the configuration file, return the toolchains
+# to build as (name, builtin, versions), an empty list if there is none. The
+# builtin key and the package keys list versions separated by spaces or
+# commas, 'all' for every known version; a package without key uses the
+# default version of the builtin target.
+def readMatrix(cmdopt, builtins):
+    config = ConfigParser.ConfigParser()
+    config.read(cmdopt.config)
+    section = 'matrix'
+    if not config.has_section(section):
+        return []
+    names = readOptions(config, section, 'builtin').replace(',', ' ').split()
+    if not names:
+        names = [name for name in builtins if name != '']
+    if not names:
+        print('Error ! The matrix needs builtin targets.')
+        sys.exit(1)
+    if names == ['all']:
+        names = builtinNames('all')
+    toolchains = []
+    for builtin in names:
+        if builtin not in builtinTarget:
+            print('Error ! Wrong buili-in target : ' + builtin)
+            sys.exit(1)
+        choices = []
+        for package in versionPackages:
+            value = readOptions(config, section, package).replace(',', ' ').split()
+            if value == ['all']:
+                value = versionIndex.range(builtin, package)
+            elif not value:
+                value = [builtinTarget[builtin]['default-' + package]]
+            choices.append(value)
+        combos = [()]
+        for values in choices:
+            combos = [combo + (value,) for combo in combos for value in values]
+        for combo in combos:
+            versions = dict(zip(versionPackages, combo))
+            if not versionIndex.accepts(builtin, versions):
+                printMessage('Warning : ' + builtin + ' ' +
+                             ' '.join([p + '-' + versions[p] for p in versionPackages]) +
+                             ' does not work, left out of the matrix.')
+                continue
+            name = '-'.join([builtin] + [p + '-' + versions[p] for p in versionPackages])
+            toolchains.append((name, builtin, versions))
+    return toolchains
+
+# The result of every toolchain of a batch or matrix build, with the stages
+# it got from the stage cache.
+def resultTable(scheduler, names):
+    lines = ['%-60s %-24s %s' % ('Toolchain', 'Result', 'Shared')]
+    for name in names:
+        stages = [s for s in scheduler.stages if s.name.startswith(name + ':')]
+        failed = [s for s in stages if s in scheduler.failed]
+        if failed:
+            result = 'failed at ' + stageKind(failed[0].name)
+        elif [s for s in stages if s not in scheduler.done]:
+            result = 'not built'
+        else:
+            result = 'pass'
+        shared = [stageKind(s.name) for s in stages if s in scheduler.restored]
+        lines.append('%-60s %-24s %s' % (name, result, ' '.join(shared)))
+    return '\n'.join(lines)
+
 def main():
     cmdopt = handleOptions()
     configFile = ''
+    if cmdopt.serve != '':
+        serve(cmdopt)
+        return
+    if cmdopt.worker != '':
+        workerServe(cmdopt)
+        return
+    if cmdopt.deploy != '':
+        deployToolchain(os.path.abspath(cmdopt.deploy), os.path.abspath(cmdopt.prefix),
+                        cmdopt.jobs)
+        return
 
-    buildConfig = BuildConfig()
+    builtins = [cmdopt.builtin]
+    if cmdopt.builtin != '':
+        builtins = builtinNames(cmdopt.builtin)
+    # The toolchains to build, as (name, builtin, versions).
+    toolchains = [(builtin, builtin, {}) for builtin in builtins]
+    matrix = []
     if cmdopt.config != '':
-        readConfigFile(buildConfig, cmdopt)
-    configureTarget(buildConfig, cmdopt)
-    # Get source code first.
-    getSource(buildConfig)
-
-    setEnv()
-    if not 'binutils' in cmdopt.skipList and not 'all' in cmdopt.skipList:
-        buildBinutils(buildConfig)
-    setEnvPath(buildConfig)
-
-    if not 'gcc1' in cmdopt.skipList and not 'all' in cmdopt.skipList:
-        buildGccPass1(buildConfig)
-
-    if not 'header' in cmdopt.skipList and not 'all' in cmdopt.skipList:
-        installKernelHeader(buildConfig)
-
-    if not 'glibc' in cmdopt.skipList and not 'all' in cmdopt.skipList:
-        buildGlibc(buildConfig)
-    # I don't known why this hack should be done.
-    if cmdopt.sysroot == True:
-        hackLibPath(buildConfig)
-
-    if not 'gcc2' in cmdopt.skipList and not 'all' in cmdopt.skipList:
-        buildGccPass2(buildConfig)
+        matrix = readMatrix(cmdopt, builtins)
+    if matrix:
+        toolchains = matrix
+        cmdopt.keepGoing = True
+    batch = len(toolchains) > 1
+    buildConfigs = []
+    for name, builtin, versions in toolchains:
+        buildConfig = BuildConfig()
+        if cmdopt.config != '':
+            readConfigFile(buildConfig, cmdopt)
+        for package, version in versions.items():
+            setattr(buildConfig, package, version)
+        subdir = ''
+        if batch:
+            subdir = name
+        configureTarget(buildConfig, cmdopt, builtin, subdir)
+        buildConfigs.append(buildConfig)
+    if cmdopt.plan:
+        # Nothing is downloaded or extracted, the sources are where they
+        # would be.
+        for buildConfig in buildConfigs:
+            if cmdopt.sharedCache != '':
+                buildConfig.sharedCache = os.path.abspath(cmdopt.sharedCache)
+            setSourcePaths(buildConfig)
+    else:
+        # Get source code first.
+        extractJobs = cmdopt.extractJobs
+        if extractJobs == 0:
+            extractJobs = cmdopt.jobs
+        downloader = Downloader(cmdopt.mirrors + defaultMirrors, cmdopt.checksums)
+        shared = None
+        if cmdopt.sharedCache != '':
+            shared = SharedSourceCache(cmdopt.sharedCache, downloader)
+            for buildConfig in buildConfigs:
+                buildConfig.sharedCache = shared.path
+        getSource(buildConfigs, extractJobs, downloader, shared)
+
+    cache = None
+    if cmdopt.cacheDir != '':
+        if cmdopt.incremental:
+            # Source trees may carry local changes the keys know nothing about.
+            print('Warning : Stage cache is not used in incremental mode.')
+        else:
+            cache = StageCache(cmdopt.cacheDir)
+    elif matrix and not cmdopt.incremental:
+        # The toolchains of a matrix share their stages through the cache.
+        cache = StageCache(buildConfigs[0].workdir + '/cache')
+    if cmdopt.scratch != '' and not cmdopt.plan:
+        scratch = ScratchSpace(cmdopt.scratch)
+        for buildConfig in buildConfigs:
+            buildConfig.options.scratch = scratch
+    # All the toolchains share one job budget, each of them has its own
+    # build directory in batch mode.
+    stages = buildHeaderStages(buildConfigs, cmdopt)
+    for (name, builtin, versions), buildConfig in zip(toolchains, buildConfigs):
+        tag = ''
+        if batch:
+            tag = name + ':'
+            buildConfig.build = buildConfig.build + '/' + name
+            if not os.path.exists(buildConfig.build) and not cmdopt.plan:
+                os.mkdir(buildConfig.build)
+        stages.extend(buildStageGraph(buildConfig, cmdopt, tag))
+    state = BuildState(buildConfigs[0].workdir, cmdopt.plan)
+    for name in cmdopt.fromStages:
+        matched = [stage for stage in stages
+                   if name == stage.name or name == stageKind(stage.name)]
+        if not matched:
+            print('Error ! No stage named ' + name + '.')
+            sys.exit(1)
+        for stage in matched:
+            state.forget(stage.name)
+    if cmdopt.plan:
+        for buildConfig in buildConfigs:
+            buildConfig.freeze()
+        printPlan(Scheduler(stages, cmdopt.jobs, cache, state=state,
+                            resume=not cmdopt.incremental), buildConfigs, cmdopt)
+        return
+    launcherDirs = []
+    for buildConfig in buildConfigs:
+        launcherDir = buildConfig.options.launcherDir
+        if launcherDir != '' and launcherDir not in launcherDirs:
+            if not os.path.exists(launcherDir):
+                os.makedirs(launcherDir)
+            zeroLauncherStats(cmdopt.launcher, launcherDir)
+            launcherDirs.append(launcherDir)
+    memory = 0
+    if cmdopt.autoJobs:
+        # Leave some memory to the rest of the system.
+        memory = memAvailable() * 9 // 10
+        history = readHistory(buildConfigs[0].workdir)
+        for stage in stages:
+            stage.memPerJob = stageMemory(history, stage.name)
+    if cmdopt.jobserver:
+        jobserver = MakeJobserver(cmdopt.jobs)
+        for buildConfig in buildConfigs:
+            buildConfig.options.jobserver = jobserver
+    if not cmdopt.verbose:
+        buildLogs.directory = cmdopt.logDir
+        if buildLogs.directory == '':
+            buildLogs.directory = buildConfigs[0].workdir + '/logs'
+        if not os.path.exists(buildLogs.directory):
+            os.makedirs(buildLogs.directory)
+        buildLogs.startProgress()
+    processEngine.timeouts = cmdopt.timeouts
+    # The stages only read the configurations from now on.
+    for buildConfig in buildConfigs:
+        buildConfig.freeze()
+    workers = []
+    if cmdopt.remotes:
+        token = readWorkerToken(cmdopt.workerToken)
+        workers = [WorkerExecutor(address, token) for address in cmdopt.remotes]
+    scheduler = Scheduler(stages, cmdopt.jobs, cache, memory, state, cmdopt.keepGoing,
+                          workers, not cmdopt.incremental)
+    success = scheduler.run()
+    printMessage(buildReport.summary())
+    if batch:
+        printMessage(resultTable(scheduler, [t[0] for t in toolchains]))
+    writeHistory(buildConfigs[0].workdir, buildReport.records,
+                 set([stage.name for stage in scheduler.done
+                      if stage not in scheduler.restored]))
+    for launcherDir in launcherDirs:
+        stats = launcherStats(cmdopt.launcher, launcherDir)
+        # The statistics of sccache are the ones of its server, not of a
+        # directory.
+        sccache = os.path.basename(cmdopt.launcher).startswith('sccache')
+        if stats is not None:
+            hits, misses = stats
+            rate = 100.0 * hits / max(1, hits + misses)
+            name = sccache and 'sccache server' or launcherDir
+            printMessage('Launcher cache ' + name + ' : ' + str(hits) + ' hits, ' +
+                         str(misses) + ' misses (%.1f%%)' % rate)
+        if sccache:
+            break
+    if cmdopt.report != '':
+        buildReport.write(cmdopt.report)
+    if not success:
+        print('Error when building toolchain.')
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()